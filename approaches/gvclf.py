@@ -5,9 +5,7 @@ from copy import deepcopy
 import torch.nn.functional as F
 
 import utils
-from arguments import get_args
-
-args = get_args()
+from dataloaders import views
 
 class Appr(object):
     """ Class implementing GVCL approach"""
@@ -15,6 +13,7 @@ class Appr(object):
     def __init__(self,model,nepochs=100,sbatch=64,lr=0.05,lr_min=1e-4,lr_factor=3,lr_patience=5,clipgrad=100,lamb = 1, beta = 1, use_film = False,args=None):
         self.model=model
         self.model_old=None
+        self.args = args
         self.fisher=None
 
         self.nepochs=nepochs
@@ -37,13 +36,25 @@ class Appr(object):
             
         self.equalize_epochs = args.equalize_epochs
         self.exp = args.experiment
+        self.epochs = views.EpochIterator(seed=args.seed, chunk=args.gather_chunk)
+        #activation bytes per example and sample of the evaluation forward, per forward mode
+        self.eval_row_bytes = {}
+        if args.compile:
+            #one compiled step per task and head
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 4*len(model.heads))
 
         return
 
     def _get_optimizer(self, parameters = None, lr=None):
         if lr is None: lr=self.lr
         if parameters is None: parameters = self.model.parameters()
-        return torch.optim.Adam(parameters, lr = self.lr)
+        #the parameters trained for the current task, the only ones the optimizer and the gradient clipping touch
+        self.trainable = [p for p in parameters if p.requires_grad]
+        #one multi-tensor kernel per update instead of a loop over the parameters: fused on cuda,
+        #foreach otherwise and under --compile, which generates its own kernels for the update
+        if all(p.is_cuda for p in self.trainable) and not self.args.compile:
+            return torch.optim.Adam(self.trainable, lr = self.lr, fused = True)
+        return torch.optim.Adam(self.trainable, lr = self.lr, foreach = True)
 
     def train(self,t,xtrain,ytrain,xvalid,yvalid):
 
@@ -52,13 +63,19 @@ class Appr(object):
 
         parameters = self.model.get_task_specific_parameters(t)
         self.optimizer=self._get_optimizer(parameters, lr)
+        self.step = torch.compile(self.train_step) if self.args.compile else self.train_step
 
         if 'chasy' not in self.exp:
             #join train and validation sets because gvcl/vcl does not use early stopping
             #except for chasy experiments where the validation set is very large compared to the test set
             #this doesn't make a major difference - 1% max
-            xtrain = torch.cat([xtrain, xvalid], dim = 0)
-            ytrain = torch.cat([ytrain, yvalid], dim = 0)
+            #splits viewing the same storage are merged without duplicating examples, but the KL normalisers and
+            #the gradient steps the hyperparameters were tuned with count the examples of both splits, valid being
+            #the training set again for split_mnist and pmnist
+            datasize = len(xtrain) + len(xvalid)
+            xtrain, ytrain = views.merge([(xtrain, ytrain), (xvalid, yvalid)])
+        else:
+            datasize = len(xtrain)
 
 
         if t != 0:
@@ -68,17 +85,19 @@ class Appr(object):
 
         #making sure every dataset has the same # of gradient passes irrespective of dataset size
         if t == 0:
-            self.first_train_size = len(xtrain)
+            self.first_train_size = datasize
             num_epochs_to_train = self.nepochs
 
             #correction if the task order is permuted (for mixture)
             if 'mixture' == self.exp:
                 self.first_train_size = 20600 #size of facescrub
-                num_epochs_to_train = int(round(self.nepochs * self.first_train_size/len(xtrain)))
+                num_epochs_to_train = int(round(self.nepochs * self.first_train_size/datasize))
         if t > 0 and self.equalize_epochs:
-            num_epochs_to_train = int(round(self.nepochs * self.first_train_size/len(xtrain)))
+            num_epochs_to_train = int(round(self.nepochs * self.first_train_size/datasize))
         else:
             num_epochs_to_train = self.nepochs
+        #as many gradient steps over the merged examples as over datasize examples
+        num_epochs_to_train = int(round(num_epochs_to_train * datasize/len(xtrain)))
 
         print('training for {} epochs'.format(num_epochs_to_train))
         
@@ -86,7 +105,7 @@ class Appr(object):
         for e in range(num_epochs_to_train):
             # Train
             clock0=time.time()
-            class_loss, kl_loss, total_loss, train_acc  = self.train_epoch(t,xtrain,ytrain)
+            class_loss, kl_loss, total_loss, train_acc  = self.train_epoch(t,xtrain,ytrain,datasize,compute_acc=(e+1) % 10 == 0)
             clock1=time.time()
 
             clock2=time.time()
@@ -95,96 +114,169 @@ class Appr(object):
                 e+1,1000*self.sbatch*(clock1-clock0)/xtrain.size(0),class_loss, kl_loss, total_loss,100*train_acc))
         return
 
-    def train_epoch(self,t,x,y):
+    def train_epoch(self,t,x,y,datasize,compute_acc=True):
+        # the running statistics stay on the device and are read once at the end of the epoch
+        # the accuracy is only computed when it is printed, and never with --skip_train_acc
         self.model.train()
+        compute_acc = compute_acc and not self.args.skip_train_acc
 
-        r=np.arange(x.size(0))
-        np.random.shuffle(r)
-        r=torch.LongTensor(r).cuda()
-
-        train_samples = args.num_samples
-        
-        epoch_class_loss = 0
-        epoch_kl_loss = 0
-        epoch_total_loss = 0
+        epoch_losses = 0
         total_hits = 0
+        nbatches = 0
 
-        for i in range(0,len(r),self.sbatch):
-            if i+self.sbatch<=len(r): b=r[i:i+self.sbatch]
-            else: b=r[i:]
-            images=torch.autograd.Variable(x[b],volatile=False)
-            targets=torch.autograd.Variable(y[b],volatile=False)
+        # Loop batches, with --compile the last batch is padded to the batch size and masked out of the loss
+        for i,b,images,targets in self.epochs(x,y,self.sbatch,pad=self.args.compile):
+            mask = None
+            if self.args.compile:
+                mask = (torch.arange(len(targets), device=targets.device) < len(b)).float()
+            losses, output = self.step(t, images, targets, datasize, mask)
+            epoch_losses += losses
+            nbatches += 1
 
-            task_labels = int(t) * torch.ones_like(targets)
-
-            # Forward current model
+            #for calculating the accuracy
+            if compute_acc:
+                with torch.no_grad():
+                    probs = F.softmax(output[:, :len(b)], dim=2).mean(dim = 0)
+                    _,pred=probs.max(1)
+                    total_hits+=(pred==targets[:len(b)]).sum()
+
+        class_loss, kl_loss, total_loss = (epoch_losses/nbatches).tolist()
+        train_acc = float(total_hits)/x.shape[0] if compute_acc else float('nan')
+        return class_loss, kl_loss, total_loss, train_acc
+
+    def train_step(self,t,images,targets,datasize,mask=None):
+        # forward, ELBO, backward, clipping and update of one batch, compiled as a whole with --compile
+        train_samples = self.args.num_samples
+        #the batch has a single task, the task-specific layers broadcast its parameters
+        task_labels = int(t)
+
+        # Forward current model
+        with utils.autocast(self.args, images.device):
             outputs=self.model(images, task_labels, tasks = [t], num_samples = train_samples)
-            output=outputs[t]
+        output=outputs[t].float()
 
-            #calculate loss for every MC sample
-            stacked_targets = targets.repeat([train_samples])
-            flattened_output = output.view(-1, output.shape[-1])
+        #calculate loss for every MC sample
+        stacked_targets = targets.repeat([train_samples])
+        flattened_output = output.view(-1, output.shape[-1])
+        if mask is None:
             class_loss = F.cross_entropy(flattened_output, stacked_targets, reduction = 'mean')
-            
-            #scale kl term by beta and dataset size
-            kl_term = self.beta * self.model.get_kl(lamb = self.lamb)/(x.shape[0])
-            loss = class_loss + kl_term
-
-            #for calculating the accuracy
-            probs = F.softmax(output, dim=2).mean(dim = 0)
-            _,pred=probs.max(1)
-            hits=(pred==targets).float()
-            total_hits+=hits.sum().data.cpu().numpy().item()
-
-            # Backward
-            self.optimizer.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm(self.model.parameters(),self.clipgrad)
-            self.optimizer.step()
+        else:
+            stacked_mask = mask.repeat([train_samples])
+            class_loss = (F.cross_entropy(flattened_output, stacked_targets, reduction = 'none') * stacked_mask).sum() / stacked_mask.sum()
+        
+        #scale kl term by beta and dataset size
+        kl_term = self.beta * self.model.get_kl(lamb = self.lamb)/datasize
+        loss = class_loss + kl_term
 
-            epoch_total_loss += loss.detach().data.item()
-            epoch_class_loss += class_loss.detach().data.item()
-            epoch_kl_loss += kl_term.detach().data.item()
+        # Backward
+        self.optimizer.zero_grad()
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(self.trainable,self.clipgrad,foreach=True)
+        self.optimizer.step()
+        #constraints of the variational parameters, kept out of the forward pass
+        self.model.project_parameters()
 
-        return epoch_class_loss/i, epoch_kl_loss/i, epoch_total_loss/i, total_hits/x.shape[0]
+        return torch.stack([class_loss, kl_term, loss]).detach(), output.detach()
 
     def eval(self,t,x,y):
-        if self.valid:
+        #with --eval_mode moments the predictions come from a single pass propagating means and variances
+        moments = self.args.eval_mode == 'moments'
+        if self.valid or moments:
             num_samples = 1
         else:
-            num_samples = args.test_samples
+            num_samples = self.args.test_samples
 
         with torch.no_grad():
             total_loss=0
             total_acc=0
             total_num=0
             self.model.eval()
+            if moments:
+                self.model.set_forward_mode('moments')
 
-            r=np.arange(x.size(0))
-            r=torch.LongTensor(r).cuda()
+            sbatch, samples = self.eval_plan(t, x, num_samples, moments)
 
             # Loop batches
-            for i in range(0,len(r),self.sbatch):
-                if i+self.sbatch<=len(r): b=r[i:i+self.sbatch]
-                else: b=r[i:]
-                images=torch.autograd.Variable(x[b],volatile=True)
-                targets=torch.autograd.Variable(y[b],volatile=True)
-
-                task_labels = int(t) * torch.ones_like(targets)
-
-                # Forward
-                outputs=self.model(images, task_labels, tasks = [t], num_samples = num_samples)
-                output=outputs[t]
-                probs = F.softmax(output, dim=2).mean(dim = 0)
-                _,pred=probs.max(1)
+            for i,b,images,targets in self.epochs(x,y,sbatch,shuffle=False):
+                task_labels = int(t)
+
+                # Forward, the predictive mean is accumulated over chunks of the Monte Carlo samples
+                probs = 0
+                for s in range(0, num_samples, samples):
+                    with utils.autocast(self.args, images.device):
+                        outputs=self.model(images, task_labels, tasks = [t], num_samples = min(samples, num_samples - s))
+                    output=outputs[t].float()
+                    probs = probs + F.softmax(output, dim=2).sum(dim = 0)
+                _,pred=(probs/num_samples).max(1)
                 hits=(pred==targets).float()
 
-                # Log
-                total_acc+=hits.sum().data.cpu().numpy().item()
+                # Log, the hits are summed on the device and read once
+                total_acc+=hits.sum()
                 total_num+=len(b)
 
+            if moments:
+                self.model.set_forward_mode('sample')
+
+            #not measuring loss for test set, just accuracy, so return -1 for loss
+            return -1, float(total_acc)/total_num
+
+    def eval_tasks(self,tasks,sets):
+        """
+            Accuracies on the test sets of several tasks in one pass, sets[k] = (x, y) being the test set of tasks[k].
+            The batches mix the tasks, the shared layers run once per batch and each row goes through its own head.
+            Returns [(loss, acc)] like eval for each task.
+        """
+        moments = self.args.eval_mode == 'moments'
+        if self.valid or moments:
+            num_samples = 1
+        else:
+            num_samples = self.args.test_samples
+
+        with torch.no_grad():
+            #indexed by task id, with --single_head the tasks outnumber the heads
+            total_acc=torch.zeros(max(tasks)+1)
+            self.model.eval()
+            if moments:
+                self.model.set_forward_mode('moments')
+
+            sbatch, samples = self.eval_plan(tasks[0], sets[0][0], num_samples, moments, sum(len(x) for x,y in sets))
+
+            # Loop batches
+            for images,targets,task_labels,segments in views.task_batches(sets,tasks,sbatch):
+
+                # Forward, the predictive mean is accumulated over chunks of the Monte Carlo samples
+                probs = [0]*len(segments)
+                for s in range(0, num_samples, samples):
+                    with utils.autocast(self.args, images.device):
+                        outputs=self.model.forward_routed(images, task_labels, segments, num_samples = min(samples, num_samples - s))
+                    for k,(u,rows,output) in enumerate(outputs):
+                        probs[k] = probs[k] + F.softmax(output.float(), dim=2).sum(dim = 0)
+                pred = torch.empty_like(targets)
+                for k,(u,rows,output) in enumerate(outputs):
+                    pred[rows] = probs[k].max(1)[1]
+                hits=(pred==targets).float()
+
+                # Log, the hits of each task are summed on the device and read once
+                total_acc=total_acc.to(hits.device).index_add_(0, task_labels, hits)
+
+            if moments:
+                self.model.set_forward_mode('sample')
+
+            total_acc=total_acc.tolist()
             #not measuring loss for test set, just accuracy, so return -1 for loss
-            return -1, total_acc/total_num
+            return [(-1, total_acc[u]/len(y)) for u,(x,y) in zip(tasks,sets)]
+
+    def eval_plan(self,t,x,num_samples,moments=False,n=None):
+        # batch size and samples per forward pass of the evaluation over n examples (default len(x)): the training
+        # batch size with all samples, or with --eval_memory the largest batch whose activations fit in the budget
+        if self.args.eval_memory <= 0:
+            return self.sbatch, num_samples
+        if moments not in self.eval_row_bytes:
+            images = x[torch.arange(1)]
+            task_labels = int(t)
+            with utils.autocast(self.args, images.device):
+                self.eval_row_bytes[moments] = utils.activation_bytes(self.model, images, task_labels, tasks = [t], num_samples = 1)
+        return utils.plan_eval(self.eval_row_bytes[moments], num_samples, self.args.eval_memory * 2**20, self.sbatch, len(x) if n is None else n)
 
     def criterion(self,t,output,targets):
         return 0
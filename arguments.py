@@ -1,6 +1,6 @@
 import argparse
 
-def get_args():
+def get_parser():
     parser=argparse.ArgumentParser(description='Continual')
     parser.add_argument('--seed',type=int,default=0,help='(default=%(default)d)')
     parser.add_argument('--experiment',default='',type=str,required=True,choices=['mnist2','pmnist','cifar','mixture', 'easy-chasy', 'hard-chasy', 'smnist', 'split_mnist', 'split_cifar100', 'split_cifar10_100', 'omniglot', 'pmnist'],help='(default=%(default)s)')
@@ -25,9 +25,35 @@ def get_args():
     parser.add_argument('--KL_coeff', type=str, choices=['1', '1_M', '1_N', 'M_N'], default='1_N', required=False) 
     parser.add_argument('--KL_weight', type=float, default=1, help='Choose the KL weight of noise') 
     parser.add_argument('--test_samples', type=int, default=20, help='Number of sample at test time') 
+    parser.add_argument('--eval_mode', type=str, default='sample', choices=['sample', 'moments'], help='test predictions from test_samples Monte Carlo samples, or from one deterministic moment propagation pass (default=%(default)s)') 
     parser.add_argument('--prior_var',default=-1,type=int,required=False,help='(default=%(default)d)')
     parser.add_argument('--equalize_epochs',type=bool,default=False,help='(default=%(default)s)')
+    parser.add_argument('--device',type=str,default='auto',help='torch device, e.g. cpu, cuda, cuda:1; auto picks cuda when available (default=%(default)s)')
+    parser.add_argument('--num_threads',type=int,default=0,help='intra-op threads, 0 keeps the torch default (default=%(default)d)')
+    parser.add_argument('--num_interop_threads',type=int,default=0,help='inter-op threads, 0 keeps the torch default (default=%(default)d)')
+    parser.add_argument('--skip_train_acc',action='store_true',default=False,help='do not compute the training accuracy, the loop then never waits for the device')
+    parser.add_argument('--precision',type=str,default='fp32',choices=['fp32','bf16'],help='precision of the forward products, bf16 uses autocast (default=%(default)s)')
+    parser.add_argument('--compile',action='store_true',default=False,help='compile the training step with torch.compile, the last batch of an epoch is padded')
+    parser.add_argument('--fused_conv',action='store_true',default=False,help='compute the mean and variance of the MF convolutions with one grouped convolution')
+    parser.add_argument('--eval_memory',type=float,default=0,help='activation memory budget of an evaluation forward pass in MB, the batch size and the Monte Carlo samples per pass are planned to fit it; 0 evaluates batch_size examples with all test_samples at once (default=%(default)s)')
+    parser.add_argument('--test_cache',type=float,default=1024,help='MB of test sets kept on the device across the tasks, least recently used first out; 0 moves them again for every evaluation (default=%(default)s)')
+    parser.add_argument('--test_cache_dtype',type=str,default='fp32',choices=['fp32','fp16','bf16'],help='dtype floating point test images are cached in, uint8 images stay uint8 (default=%(default)s)')
+    parser.add_argument('--gather_chunk',type=int,default=0,help='examples gathered at a time into the shuffled epoch buffer, 0 gathers the whole epoch at once, or 4096 at a time from normalised or permuted views (default=%(default)d)')
 
-    args=parser.parse_args()
+    return parser
+
+def get_args(argv=None):
+    # argv=None parses sys.argv, pass a list to parse anything else
+    args=get_parser().parse_args(argv)
+
+    return args
+
+def get_config(experiment, approach, **kwargs):
+    # default configuration for in-process runs, without touching sys.argv
+    args=get_args(['--experiment',experiment,'--approach',approach])
+    for name,value in kwargs.items():
+        if not hasattr(args,name):
+            raise ValueError('Unknown argument {}'.format(name))
+        setattr(args,name,value)
 
     return args
\ No newline at end of file
@@ -0,0 +1,52 @@
+import sys,os,argparse,time
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import numpy as np
+
+from main import run_experiment, load_data
+from arguments import get_config
+
+########################################################################################################################
+# Accuracy parity of --precision bf16 against fp32.
+# Both precisions train from the same seed on the same data, the final accuracy matrices are compared and the script
+# exits with status 1 when the average accuracy or any single task drifts by more than the tolerance.
+#
+#   python benchmarks/bf16_parity.py --experiments split_mnist split_cifar100 --nepochs 20
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='bf16/fp32 accuracy parity')
+    parser.add_argument('--experiments',type=str,nargs='+',default=['split_mnist','split_cifar100'])
+    parser.add_argument('--approach',type=str,default='gvclf_vd')
+    parser.add_argument('--nepochs',type=int,default=-1,help='-1 uses the tuned number of epochs (default=%(default)d)')
+    parser.add_argument('--seeds',type=int,nargs='+',default=[0])
+    parser.add_argument('--device',type=str,default='auto')
+    parser.add_argument('--tol',type=float,default=0.01,help='allowed drop of the average accuracy (default=%(default)s)')
+    parser.add_argument('--task_tol',type=float,default=0.03,help='allowed drop of any single task accuracy (default=%(default)s)')
+    opts=parser.parse_args(argv)
+
+    failed=False
+    for experiment in opts.experiments:
+        for seed in opts.seeds:
+            results={}
+            data=None
+            for precision in ['fp32','bf16']:
+                config=get_config(experiment,opts.approach,film=True,seed=seed,nepochs=opts.nepochs,device=opts.device,
+                                  precision=precision,output='./result_data/parity_{}_{}_{}.txt'.format(experiment,seed,precision))
+                if data is None:
+                    np.random.seed(seed)
+                    data=load_data(config)
+                clock=time.time()
+                acc,avg_acc,bwt=run_experiment(config,data)
+                results[precision]=(acc,avg_acc,time.time()-clock)
+
+            acc32,avg32,time32=results['fp32']
+            acc16,avg16,time16=results['bf16']
+            final=acc32.shape[0]-1
+            task_drop=np.max(acc32[final]-acc16[final])
+            ok=avg32-avg16<=opts.tol and task_drop<=opts.task_tol
+            failed=failed or not ok
+            print('{:15s} seed {:d}: fp32 {:5.1f}% ({:.0f}s)  bf16 {:5.1f}% ({:.0f}s)  max task drop {:4.1f}%  {}'.format(
+                experiment,seed,100*avg32,time32,100*avg16,time16,100*task_drop,'ok' if ok else 'FAILED'))
+    return 1 if failed else 0
+
+if __name__=='__main__':
+    sys.exit(main())
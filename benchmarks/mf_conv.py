@@ -0,0 +1,64 @@
+import sys,os,argparse,time
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import torch
+
+from main import get_network, get_device
+from arguments import get_config
+
+########################################################################################################################
+# Speed of the MF convolutions of CNNFilmVD (split_cifar100) and CNNOmniglotFilmVD (omniglot): the two separate
+# mean/variance convolutions against the fused grouped one (--fused_conv), for a Monte Carlo evaluation forward with
+# --test_samples samples and for a training forward/backward with --num_samples samples.
+#
+#   python benchmarks/mf_conv.py --device cuda --test_samples 20
+
+def bench(f, repeat, device):
+    f()
+    if device.type=='cuda': torch.cuda.synchronize()
+    clock=time.time()
+    for _ in range(repeat):
+        f()
+    if device.type=='cuda': torch.cuda.synchronize()
+    return 1000*(time.time()-clock)/repeat
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='fused MF convolution benchmark')
+    parser.add_argument('--experiments',type=str,nargs='+',default=['split_cifar100','omniglot'])
+    parser.add_argument('--device',type=str,default='auto')
+    parser.add_argument('--batch_size',type=int,default=64)
+    parser.add_argument('--test_samples',type=int,default=20)
+    parser.add_argument('--num_samples',type=int,default=1)
+    parser.add_argument('--repeat',type=int,default=10)
+    opts=parser.parse_args(argv)
+
+    for experiment in opts.experiments:
+        inputsize,ncla=([3,32,32],10) if experiment!='omniglot' else ([1,28,28],20)
+        taskcla=[(0,ncla),(1,ncla)]
+        results={}
+        for fused in [False,True]:
+            args=get_config(experiment,'gvclf_vd',film=True,conv_Dropout=True,device=opts.device,fused_conv=fused)
+            device=get_device(args)
+            torch.manual_seed(0)
+            net=get_network(experiment,'gvclf_vd').Net(inputsize,taskcla,args).to(device)
+            x=torch.randn([opts.batch_size]+inputsize,device=device)
+            task_labels=torch.zeros(opts.batch_size,dtype=torch.long,device=device)
+
+            def evaluate():
+                with torch.no_grad():
+                    return net(x,task_labels,tasks=[0],num_samples=opts.test_samples)[0]
+            def train():
+                net(x,task_labels,tasks=[0],num_samples=opts.num_samples)[0].sum().backward()
+
+            net.eval()
+            torch.manual_seed(1)
+            out=evaluate()
+            results[fused]=(out,bench(evaluate,opts.repeat,device))
+            net.train()
+            results[fused]+=(bench(train,opts.repeat,device),)
+
+        diff=(results[False][0]-results[True][0]).abs().max().item()
+        print('{:15s} eval x{:d}: separate {:7.1f}ms fused {:7.1f}ms | train: separate {:7.1f}ms fused {:7.1f}ms | max |diff| {:.2e}'.format(
+            experiment,opts.test_samples,results[False][1],results[True][1],results[False][2],results[True][2],diff))
+
+if __name__=='__main__':
+    main()
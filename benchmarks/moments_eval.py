@@ -0,0 +1,79 @@
+import sys,os,argparse,time
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import numpy as np
+import torch
+
+from main import stream_data, get_network, get_approach, get_device
+from best_hyperparams import get_best_params
+from arguments import get_config
+from dataloaders import views
+
+########################################################################################################################
+# Test accuracy and evaluation time of --eval_mode moments against the Monte Carlo evaluation with --test_samples.
+# The task sequence is trained once per experiment, then every test set is evaluated by the same model in both modes,
+# so the comparison is not blurred by the random numbers the Monte Carlo evaluation draws between tasks.
+# The moments are deterministic, so the routed evaluation of all tasks in one pass (eval_tasks) must give exactly
+# the per-task accuracies, which is checked as well, with one head per task or with --single_head.
+#
+#   python benchmarks/moments_eval.py --experiments split_mnist split_cifar100 --nepochs 20
+#   python benchmarks/moments_eval.py --experiments split_mnist --single_head
+
+def evaluate(appr, mode, test_sets, device):
+    appr.args.eval_mode = mode
+    accs = []
+    if device.type=='cuda': torch.cuda.synchronize()
+    clock=time.time()
+    for u,(x,y) in enumerate(test_sets):
+        accs.append(appr.eval(u,x,y)[1])
+    if device.type=='cuda': torch.cuda.synchronize()
+    return np.array(accs), time.time()-clock
+
+def evaluate_routed(appr, mode, test_sets):
+    appr.args.eval_mode = mode
+    return np.array([acc for loss,acc in appr.eval_tasks(list(range(len(test_sets))),test_sets)])
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description='moment propagation against Monte Carlo evaluation')
+    parser.add_argument('--experiments',type=str,nargs='+',default=['split_mnist','split_cifar100'])
+    parser.add_argument('--approach',type=str,default='gvclf_vd')
+    parser.add_argument('--nepochs',type=int,default=-1,help='-1 uses the tuned number of epochs (default=%(default)d)')
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--test_samples',type=int,default=20)
+    parser.add_argument('--device',type=str,default='auto')
+    parser.add_argument('--single_head',action='store_true',default=False)
+    opts=parser.parse_args(argv)
+
+    for experiment in opts.experiments:
+        args=get_config(experiment,opts.approach,film=True,seed=opts.seed,nepochs=opts.nepochs,device=opts.device,
+                        test_samples=opts.test_samples,single_head=opts.single_head)
+        best_param, best_lr, best_epochs = get_best_params(args.approach, args.experiment)
+        if args.nepochs == -1: args.nepochs = best_epochs
+        if args.lr == -1: args.lr = best_lr
+        if len(args.parameter) == 0: args.parameter = best_param
+        device=get_device(args)
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+
+        taskcla,inputsize,tasks=stream_data(args)
+        net=get_network(args.experiment,args.approach).Net(inputsize,taskcla,args).to(device)
+        appr=get_approach(args.approach).Appr(net,nepochs=args.nepochs,lr=args.lr,args=args,sbatch=args.batch_size)
+
+        test_sets=[]
+        for (t,ncla),(_,task_data) in zip(taskcla,tasks):
+            test_sets.append(views.to_device((task_data['test']['x'],task_data['test']['y']),device))
+            xtrain,ytrain,xvalid,yvalid=views.to_device([task_data['train']['x'],task_data['train']['y'],
+                                                         task_data['valid']['x'],task_data['valid']['y']],device)
+            appr.train(t,xtrain,ytrain,xvalid,yvalid)
+
+        appr.valid=False
+        acc_mc,time_mc=evaluate(appr,'sample',test_sets,device)
+        acc_mo,time_mo=evaluate(appr,'moments',test_sets,device)
+        print('{:15s} sample x{:d}: {:5.1f}% ({:.2f}s)  moments: {:5.1f}% ({:.2f}s)  max task |diff| {:4.1f}%'.format(
+            experiment,args.test_samples,100*acc_mc.mean(),time_mc,100*acc_mo.mean(),time_mo,100*np.abs(acc_mc-acc_mo).max()))
+        acc_ro=evaluate_routed(appr,'moments',test_sets)
+        print('{:15s} routed moments: {:5.1f}%  max task |diff| to per-task {:4.1f}%'.format(
+            experiment,100*acc_ro.mean(),100*np.abs(acc_ro-acc_mo).max()))
+        assert np.array_equal(acc_ro,acc_mo), 'routed and per-task moment evaluations differ'
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,206 @@
+import os, json, threading, queue
+import numpy as np
+import torch
+import h5py
+from dataloaders import task_cache
+
+########################################################################################################################
+# HDF5 task store for benchmarks with many tasks.
+#
+# Every task and split is a group task{t}/{split} of datasets chunked along the examples, and the file attributes
+# hold the preprocessing hash, the loader metadata and a complete flag written last. The file is built under a
+# temporary name and renamed into place like the .npy caches of task_cache.
+# Tasks are opened as H5Views that read the chunks a batch touches and nothing else, so memory depends on the
+# batch size and not on the number of tasks in the file.
+# A shuffled batch touches about one chunk per example, so the chunks are kept small: an epoch reads at most
+# CHUNK_ROWS times the task from disk, whatever its size, while larger chunks would read the whole task per batch.
+
+CHUNK_ROWS = 16
+READ_AHEAD = 2
+
+# same hash as the .npy caches
+preprocessing_hash = task_cache.preprocessing_hash
+
+def is_complete(path, phash):
+    if not os.path.isfile(path):
+        return False
+    try:
+        with h5py.File(path, 'r') as f:
+            # stores written with another chunk size are rebuilt
+            return bool(f.attrs.get('complete', False)) and f.attrs.get('hash') == phash and f.attrs.get('chunk_rows') == CHUNK_ROWS
+    except OSError:
+        return False
+
+def load_manifest(path):
+    with h5py.File(path, 'r') as f:
+        return {'hash': f.attrs['hash'], 'meta': json.loads(f.attrs['meta']), 'tasks': json.loads(f.attrs['tasks'])}
+
+def write(path, tasks, phash, meta=None):
+    """
+        Atomically write the HDF5 store path from tasks, an iterable of (task, {split: {name: array}}).
+        Tasks are consumed one at a time, so a generator keeps a single task in memory while building.
+    """
+    tmp = '{}.tmp-{}'.format(path, os.getpid())
+    index = {}
+    with h5py.File(tmp, 'w') as f:
+        for t, splits in tasks:
+            index[str(t)] = {}
+            for s, arrays in splits.items():
+                index[str(t)][s] = []
+                for name, arr in arrays.items():
+                    arr = np.ascontiguousarray(torch.as_tensor(arr).numpy())
+                    chunks = (max(1, min(CHUNK_ROWS, arr.shape[0])),) + arr.shape[1:]
+                    f.create_dataset('task{}/{}/{}'.format(t, s, name), data=arr, chunks=chunks)
+                    index[str(t)][s].append(name)
+        f.attrs['hash'] = phash
+        f.attrs['meta'] = json.dumps(meta if meta is not None else {})
+        f.attrs['tasks'] = json.dumps(index)
+        f.attrs['chunk_rows'] = CHUNK_ROWS
+        f.flush()
+        f.attrs['complete'] = True
+    with open(tmp, 'rb+') as f:
+        os.fsync(f.fileno())
+
+    # another process may have finished the same store in the meantime
+    if is_complete(path, phash):
+        os.remove(tmp)
+        return
+    with _files_lock:
+        if path in _files:
+            _files.pop(path).close()
+    os.replace(tmp, path)
+
+def open_task(path, t, manifest=None):
+    """
+        Open task t of a complete store as {split: {name: H5View}}.
+    """
+    if manifest is None:
+        manifest = load_manifest(path)
+    task = {}
+    for s, names in manifest['tasks'][str(t)].items():
+        task[s] = {name: H5View(path, ['task{}/{}/{}'.format(t, s, name)]) for name in names}
+    return task
+
+def task_ids(manifest):
+    return sorted(int(t) for t in manifest['tasks'].keys())
+
+# one read-only handle per file and process, h5py serialises the reads of the prefetch threads
+_files = {}
+_files_lock = threading.Lock()
+
+def _dataset(path, key):
+    with _files_lock:
+        if path not in _files:
+            _files[path] = h5py.File(path, 'r')
+        return _files[path][key]
+
+
+class H5View(object):
+    def __init__(self, path, keys, device='cpu'):
+        """
+            :param path: HDF5 store written by write()
+            :param keys: datasets concatenated along the examples, e.g. the train and valid splits of a task
+            :param device: device the gathered batches are moved to
+        """
+        self.path = path
+        self.keys = list(keys)
+        self.device = torch.device(device)
+        sizes = [_dataset(path, k).shape[0] for k in self.keys]
+        self.item_shape = _dataset(path, self.keys[0]).shape[1:]
+        self.np_dtype = _dataset(path, self.keys[0]).dtype
+        self.offsets = np.cumsum([0] + sizes)
+
+    def __getitem__(self, b):
+        return self.read(b).to(self.device, non_blocking=True)
+
+    def read(self, b):
+        # gather on the host, reading each touched chunk once in file order
+        rows = torch.as_tensor(b).cpu().numpy().reshape(-1)
+        order = np.argsort(rows, kind='stable')
+        out = np.empty((len(rows),) + self.item_shape, dtype=self.np_dtype)
+        sorted_rows = rows[order]
+        for k, key in enumerate(self.keys):
+            lo, hi = np.searchsorted(sorted_rows, [self.offsets[k], self.offsets[k+1]])
+            if lo == hi:
+                continue
+            ds = _dataset(self.path, key)
+            local = sorted_rows[lo:hi] - self.offsets[k]
+            chunk_ids = local // ds.chunks[0]
+            for c in np.unique(chunk_ids):
+                a, z = np.searchsorted(chunk_ids, [c, c+1])
+                start = c * ds.chunks[0]
+                block = ds[start:min(start + ds.chunks[0], ds.shape[0])]
+                out[order[lo+a:lo+z]] = block[local[a:z] - start]
+        x = torch.from_numpy(out)
+        if self.device.type == 'cuda':
+            x = x.pin_memory()
+        return x
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def size(self, dim=None):
+        if dim is None:
+            return self.shape
+        return self.shape[dim]
+
+    @property
+    def shape(self):
+        return torch.Size((len(self),) + self.item_shape)
+
+    @property
+    def dtype(self):
+        return torch.from_numpy(np.empty(0, dtype=self.np_dtype)).dtype
+
+    def to(self, device):
+        return H5View(self.path, self.keys, device)
+
+    def materialise(self):
+        return self[torch.arange(len(self))]
+
+    @staticmethod
+    def cat(views):
+        # concatenation only extends the list of datasets, nothing is read
+        if any(not isinstance(v, H5View) or v.path != views[0].path or v.device != views[0].device for v in views):
+            return None
+        return H5View(views[0].path, [k for v in views for k in v.keys], views[0].device)
+
+    def prefetch(self, others, batches, depth=READ_AHEAD):
+        """
+            Yield [self[b]] + [o[b] for o in others] for every b in batches, read by a background thread
+            which stays at most depth batches ahead.
+        """
+        q = queue.Queue(maxsize=depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def reader():
+            try:
+                for b in batches:
+                    if not put([v.read(b) if isinstance(v, H5View) else v[b] for v in [self] + others]):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = q.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield [x.to(v.device, non_blocking=True) if isinstance(v, H5View) else x for v, x in zip([self] + others, item)]
+        finally:
+            stop.set()
+            thread.join()
@@ -1,16 +1,17 @@
 import os, sys
 import numpy as np
 import torch
+import utils
+from dataloaders import views
 from torchvision import datasets, transforms
 from sklearn.utils import shuffle
 
 
 ########################################################################################################################
 
-def get(seed=0, fixed_order=False, pc_valid=0, tasknum = 10):
-    data = {}
-    taskcla = []
+def stream(seed=0, fixed_order=False, pc_valid=0, tasknum = 10):
     size = [1, 28, 28]
+    taskcla = [(t, 10) for t in range(tasknum)]
     # Pre-load
     # MNIST
     mean = torch.Tensor([0.1307])
@@ -19,39 +20,38 @@ def get(seed=0, fixed_order=False, pc_valid=0, tasknum = 10):
     dat['train'] = datasets.MNIST('../dat/', train=True, download=True)
     dat['test'] = datasets.MNIST('../dat/', train=False, download=True)
     
-    for i in range(tasknum):
-        print(i, end=',')
-        sys.stdout.flush()
-        data[i] = {}
-        data[i]['name'] = 'pmnist-{:d}'.format(i)
-        data[i]['ncla'] = 10
-        permutation = np.random.permutation(28*28)
-        for s in ['train', 'test']:
-            if s == 'train':
-                arr = dat[s].data.view(dat[s].data.shape[0],-1).float()
-                label = torch.LongTensor(dat[s].targets)
-            else:
-                arr = dat[s].data.view(dat[s].data.shape[0],-1).float()
-                label = torch.LongTensor(dat[s].targets)
-                
-            arr = (arr/255 - mean) / std
-            data[i][s]={}
-            data[i][s]['x'] = arr[:,permutation].view(-1, size[0], size[1], size[2])
-            data[i][s]['y'] = label
-            
-    # Validation
-    for t in range(tasknum):
-        data[t]['valid'] = {}
-        data[t]['valid']['x'] = data[t]['train']['x'].clone()
-        data[t]['valid']['y'] = data[t]['train']['y'].clone()
-
-    # Others
-    n = 0
-    for t in range(tasknum):
-        taskcla.append((t, data[t]['ncla']))
-        n += data[t]['ncla']
-    data['ncla'] = n
+    # The uint8 images are stored once, each task only keeps its pixel permutation
+    # which the views apply to every gathered batch after normalizing it
+    base = {}
+    label = {}
+    for s in ['train', 'test']:
+        base[s] = utils.images_to_uint8(dat[s].data)
+        label[s] = torch.LongTensor(dat[s].targets)
+
+    # drawn up front so that the permutations do not depend on when the tasks are consumed
+    permutations = [torch.from_numpy(np.random.permutation(28*28)) for i in range(tasknum)]
+
+    def tasks():
+        for i in range(tasknum):
+            task = {}
+            task['name'] = 'pmnist-{:d}'.format(i)
+            task['ncla'] = 10
+            for s in ['train', 'test']:
+                task[s]={}
+                task[s]['x'] = views.TensorView(base[s], perm=permutations[i], mean=mean, std=std)
+                task[s]['y'] = views.TensorView(label[s])
+            # Validation
+            task['valid'] = {}
+            task['valid']['x'] = task['train']['x']
+            task['valid']['y'] = task['train']['y']
+            yield i, task
 
+    return taskcla, size, tasks()
+
+def get(seed=0, fixed_order=False, pc_valid=0, tasknum = 10):
+    taskcla, size, tasks = stream(seed=seed, fixed_order=fixed_order, pc_valid=pc_valid, tasknum=tasknum)
+    data = dict(tasks)
+    data['ncla'] = sum(ncla for t, ncla in taskcla)
     return data, taskcla, size
 
 ########################################################################################################################
\ No newline at end of file
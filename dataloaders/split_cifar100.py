@@ -2,84 +2,68 @@ import os,sys
 import numpy as np
 import torch
 import utils
+from dataloaders import task_cache, views
 from torchvision import datasets,transforms
 from sklearn.utils import shuffle
 
-def get(seed=0,pc_valid=0.10, tasknum = 20):
-    data={}
-    taskcla=[]
-    size=[3,32,32]
-
-    if not os.path.isdir('../dat/binary_split_cifar100/'):
-        os.makedirs('../dat/binary_split_cifar100')
+cache_dir='../dat/binary_split_cifar100'
+mean=[x/255 for x in [125.3,123.0,113.9]]
+std=[x/255 for x in [63.0,62.1,66.7]]
 
-        mean=[x/255 for x in [125.3,123.0,113.9]]
-        std=[x/255 for x in [63.0,62.1,66.7]]
-        
-        # CIFAR100
+def make_cache():
+    # CIFAR100 as tasks 1..10 of 10 classes each, also used by split_cifar10_100
+    phash=task_cache.preprocessing_hash(dataset='cifar100',tasks='split_cifar100',dtype='uint8')
+    if not task_cache.is_complete(cache_dir,phash):
         dat={}
-        
-        dat['train']=datasets.CIFAR100('../dat/',train=True,download=True,
-                                       transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-        dat['test']=datasets.CIFAR100('../dat/',train=False,download=True,
-                                       transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-        for n in range(10):
-            data[n]={}
-            data[n]['name']='cifar100'
-            data[n]['ncla']=10
-            data[n]['train']={'x': [],'y': []}
-            data[n]['test']={'x': [],'y': []}
+        dat['train']=datasets.CIFAR100('../dat/',train=True,download=True)
+        dat['test']=datasets.CIFAR100('../dat/',train=False,download=True)
+        tasks={}
+        for t in range(1,11):
+            tasks[t]={'train': {},'test': {}}
         for s in ['train','test']:
-            loader=torch.utils.data.DataLoader(dat[s],batch_size=1,shuffle=False)
-            for image,target in loader:
-                task_idx = target.numpy()[0] // 10
-                data[task_idx][s]['x'].append(image)
-                data[task_idx][s]['y'].append(target.numpy()[0]%10)
+            images=utils.images_to_uint8(dat[s].data)
+            targets=torch.as_tensor(dat[s].targets).long()
+            for t in range(1,11):
+                task_mask=(targets//10+1)==t
+                tasks[t][s]['x']=images[task_mask]
+                tasks[t][s]['y']=targets[task_mask]%10
+        ncla={t: len(np.unique(tasks[t]['train']['y'].numpy())) for t in tasks}
+        task_cache.write(cache_dir,tasks,phash,meta={'ncla': ncla})
+    return cache_dir
+
+def stream(seed=0,pc_valid=0.10, tasknum = 20):
+    size=[3,32,32]
 
-        # "Unify" and save
-        for t in range(10):
-            for s in ['train','test']:
-                data[t][s]['x']=torch.stack(data[t][s]['x']).view(-1,size[0],size[1],size[2])
-                data[t][s]['y']=torch.LongTensor(np.array(data[t][s]['y'],dtype=int)).view(-1)
-                torch.save(data[t][s]['x'], os.path.join(os.path.expanduser('../dat/binary_split_cifar100'),
-                                                         'data'+str(t+1)+s+'x.bin'))
-                torch.save(data[t][s]['y'], os.path.join(os.path.expanduser('../dat/binary_split_cifar100'),
-                                                         'data'+str(t+1)+s+'y.bin'))
-    
-    # Load binary files
-    data={}
-    data[0] = dict.fromkeys(['name','ncla','train','test'])
+    # The task order and sizes come from the manifest, the tasks are opened when the generator reaches them
+    manifest=task_cache.load_manifest(make_cache())
     ids=list(shuffle(np.arange(10),random_state=seed)+1)
     print('Task order =',ids)
-    for i in range(10):
-        data[i] = dict.fromkeys(['name','ncla','train','test'])
-        for s in ['train','test']:
-            data[i][s]={'x':[],'y':[]}
-            data[i][s]['x']=torch.load(os.path.join(os.path.expanduser('../dat/binary_split_cifar100'),
-                                                    'data'+str(ids[i])+s+'x.bin'))
-            data[i][s]['y']=torch.load(os.path.join(os.path.expanduser('../dat/binary_split_cifar100'),
-                                                    'data'+str(ids[i])+s+'y.bin'))
-        data[i]['ncla']=len(np.unique(data[i]['train']['y'].numpy()))
-        data[i]['name']='cifar100-'+str(ids[i-1])
-            
-    # Validation
-    for t in range(10):
-        r=np.arange(data[t]['train']['x'].size(0))
-        r=np.array(shuffle(r,random_state=seed),dtype=int)
-        nvalid=int(pc_valid*len(r))
-        ivalid=torch.LongTensor(r[:nvalid])
-        itrain=torch.LongTensor(r[nvalid:])
-        data[t]['valid']={}
-        data[t]['valid']['x']=data[t]['train']['x'][ivalid].clone()
-        data[t]['valid']['y']=data[t]['train']['y'][ivalid].clone()
-        data[t]['train']['x']=data[t]['train']['x'][itrain].clone()
-        data[t]['train']['y']=data[t]['train']['y'][itrain].clone()
+    taskcla=[(i,manifest['meta']['ncla'][str(ids[i])]) for i in range(10)]
+
+    def tasks():
+        for i in range(10):
+            task=task_cache.open_task(cache_dir,ids[i],manifest)
+            task['ncla']=manifest['meta']['ncla'][str(ids[i])]
+            task['name']='cifar100-'+str(ids[i-1])
 
-    # Others
-    n=0
-    for t in range(10):
-        taskcla.append((t,data[t]['ncla']))
-        n+=data[t]['ncla']
-    data['ncla']=n
+            # Validation, all splits keep the uint8 images and are normalised per batch
+            r=np.arange(task['train']['x'].size(0))
+            r=np.array(shuffle(r,random_state=seed),dtype=int)
+            nvalid=int(pc_valid*len(r))
+            ivalid=torch.LongTensor(r[:nvalid])
+            itrain=torch.LongTensor(r[nvalid:])
+            task['valid']={}
+            task['valid']['x']=views.TensorView(task['train']['x'],ivalid,mean=mean,std=std)
+            task['valid']['y']=views.TensorView(task['train']['y'],ivalid)
+            task['train']['x']=views.TensorView(task['train']['x'],itrain,mean=mean,std=std)
+            task['train']['y']=views.TensorView(task['train']['y'],itrain)
+            task['test']['x']=views.TensorView(task['test']['x'],mean=mean,std=std)
+            yield i,task
 
-    return data,taskcla,size
\ No newline at end of file
+    return taskcla,size,tasks()
+
+def get(seed=0,pc_valid=0.10, tasknum = 20):
+    taskcla,size,tasks=stream(seed=seed,pc_valid=pc_valid,tasknum=tasknum)
+    data=dict(tasks)
+    data['ncla']=sum(ncla for t,ncla in taskcla)
+    return data,taskcla,size
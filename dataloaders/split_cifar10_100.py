@@ -2,116 +2,68 @@ import os,sys
 import numpy as np
 import torch
 import utils
+from dataloaders import task_cache, views, split_cifar100
 from torchvision import datasets,transforms
 from sklearn.utils import shuffle
 
-def get(seed=0,pc_valid=0.10, tasknum = 10):
-    data={}
-    taskcla=[]
-    size=[3,32,32]
-
-    if not os.path.isdir('../dat/binary_split_cifar100/'):
-        os.makedirs('../dat/binary_split_cifar100')
-        os.makedirs('../dat/binary_cifar10')
+cache_dir='../dat/binary_cifar10'
 
-        mean=[x/255 for x in [125.3,123.0,113.9]]
-        std=[x/255 for x in [63.0,62.1,66.7]]
-        
-        # CIFAR10
+def make_cache():
+    # CIFAR10 as a single task 0
+    phash=task_cache.preprocessing_hash(dataset='cifar10',tasks='cifar10',dtype='uint8')
+    if not task_cache.is_complete(cache_dir,phash):
         dat={}
-        dat['train']=datasets.CIFAR10('../dat/',train=True,download=True,
-                                      transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-        dat['test']=datasets.CIFAR10('../dat/',train=False,download=True,
-                                     transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-        data[0]={}
-        data[0]['name']='cifar10'
-        data[0]['ncla']=10
-        data[0]['train']={'x': [],'y': []}
-        data[0]['test']={'x': [],'y': []}
+        dat['train']=datasets.CIFAR10('../dat/',train=True,download=True)
+        dat['test']=datasets.CIFAR10('../dat/',train=False,download=True)
+        tasks={0: {'train': {},'test': {}}}
         for s in ['train','test']:
-            loader=torch.utils.data.DataLoader(dat[s],batch_size=1,shuffle=False)
-            for image,target in loader:
-                data[0][s]['x'].append(image)
-                data[0][s]['y'].append(target.numpy()[0])
-        
-        
-        # CIFAR100
-        dat={}
-        
-        dat['train']=datasets.CIFAR100('../dat/',train=True,download=True,
-                                       transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-        dat['test']=datasets.CIFAR100('../dat/',train=False,download=True,
-                                       transform=transforms.Compose([transforms.ToTensor(),transforms.Normalize(mean,std)]))
-        for n in range(1,11):
-            data[n]={}
-            data[n]['name']='cifar100'
-            data[n]['ncla']=10
-            data[n]['train']={'x': [],'y': []}
-            data[n]['test']={'x': [],'y': []}
-        for s in ['train','test']:
-            loader=torch.utils.data.DataLoader(dat[s],batch_size=1,shuffle=False)
-            for image,target in loader:
-                task_idx = target.numpy()[0] // 10 + 1
-                data[task_idx][s]['x'].append(image)
-                data[task_idx][s]['y'].append(target.numpy()[0]%10)
+            tasks[0][s]['x']=utils.images_to_uint8(dat[s].data)
+            tasks[0][s]['y']=torch.as_tensor(dat[s].targets).long()
+        ncla={0: len(np.unique(tasks[0]['train']['y'].numpy()))}
+        task_cache.write(cache_dir,tasks,phash,meta={'ncla': ncla})
+    return cache_dir
 
-        # "Unify" and save
-        for s in ['train','test']:
-            data[0][s]['x']=torch.stack(data[0][s]['x']).view(-1,size[0],size[1],size[2])
-            data[0][s]['y']=torch.LongTensor(np.array(data[0][s]['y'],dtype=int)).view(-1)
-            torch.save(data[0][s]['x'], os.path.join(os.path.expanduser('../dat/binary_cifar10'),'data'+s+'x.bin'))
-            torch.save(data[0][s]['y'], os.path.join(os.path.expanduser('../dat/binary_cifar10'),'data'+s+'y.bin'))
-        for t in range(1,11):
-            for s in ['train','test']:
-                data[t][s]['x']=torch.stack(data[t][s]['x']).view(-1,size[0],size[1],size[2])
-                data[t][s]['y']=torch.LongTensor(np.array(data[t][s]['y'],dtype=int)).view(-1)
-                torch.save(data[t][s]['x'], os.path.join(os.path.expanduser('../dat/binary_split_cifar100'),
-                                                         'data'+str(t)+s+'x.bin'))
-                torch.save(data[t][s]['y'], os.path.join(os.path.expanduser('../dat/binary_split_cifar100'),
-                                                         'data'+str(t)+s+'y.bin'))
-    
-    # Load binary files
-    data={}
-    data[0] = dict.fromkeys(['name','ncla','train','test'])
-    for s in ['train','test']:
-        data[0][s]={'x':[],'y':[]}
-        data[0][s]['x']=torch.load(os.path.join(os.path.expanduser('../dat/binary_cifar10'),'data'+s+'x.bin'))
-        data[0][s]['y']=torch.load(os.path.join(os.path.expanduser('../dat/binary_cifar10'),'data'+s+'y.bin'))
-    data[0]['ncla']=len(np.unique(data[0]['train']['y'].numpy()))
-    data[0]['name']='cifar10'
-    
+def stream(seed=0,pc_valid=0.10, tasknum = 10):
+    size=[3,32,32]
+
+    # The task order and sizes come from the manifests, the tasks are opened when the generator reaches them
+    manifest10=task_cache.load_manifest(make_cache())
+    manifest=task_cache.load_manifest(split_cifar100.make_cache())
     ids=list(shuffle(np.arange(10),random_state=seed) + 1)
 #     ids=list(range(1,11))
     print('Task order =',ids)
-    for i in range(1,11):
-        data[i] = dict.fromkeys(['name','ncla','train','test'])
-        for s in ['train','test']:
-            data[i][s]={'x':[],'y':[]}
-            data[i][s]['x']=torch.load(os.path.join(os.path.expanduser('../dat/binary_split_cifar100'),
-                                                    'data'+str(ids[i-1])+s+'x.bin'))
-            data[i][s]['y']=torch.load(os.path.join(os.path.expanduser('../dat/binary_split_cifar100'),
-                                                    'data'+str(ids[i-1])+s+'y.bin'))
-        data[i]['ncla']=len(np.unique(data[i]['train']['y'].numpy()))
-        data[i]['name']='cifar100-'+str(ids[i-1])
-            
-    # Validation
-    for t in range(11):
-        r=np.arange(data[t]['train']['x'].size(0))
-        r=np.array(shuffle(r,random_state=seed),dtype=int)
-        nvalid=int(pc_valid*len(r))
-        ivalid=torch.LongTensor(r[:nvalid])
-        itrain=torch.LongTensor(r[nvalid:])
-        data[t]['valid']={}
-        data[t]['valid']['x']=data[t]['train']['x'][ivalid].clone()
-        data[t]['valid']['y']=data[t]['train']['y'][ivalid].clone()
-        data[t]['train']['x']=data[t]['train']['x'][itrain].clone()
-        data[t]['train']['y']=data[t]['train']['y'][itrain].clone()
+    taskcla=[(0,manifest10['meta']['ncla']['0'])]+[(i,manifest['meta']['ncla'][str(ids[i-1])]) for i in range(1,11)]
 
-    # Others
-    n=0
-    for t in range(11):
-        taskcla.append((t,data[t]['ncla']))
-        n+=data[t]['ncla']
-    data['ncla']=n
+    def tasks():
+        mean,std=split_cifar100.mean,split_cifar100.std
+        for i in range(11):
+            if i==0:
+                task=task_cache.open_task(cache_dir,0,manifest10)
+                task['ncla']=manifest10['meta']['ncla']['0']
+                task['name']='cifar10'
+            else:
+                task=task_cache.open_task(split_cifar100.cache_dir,ids[i-1],manifest)
+                task['ncla']=manifest['meta']['ncla'][str(ids[i-1])]
+                task['name']='cifar100-'+str(ids[i-1])
 
-    return data,taskcla,size
\ No newline at end of file
+            # Validation, all splits keep the uint8 images and are normalised per batch
+            r=np.arange(task['train']['x'].size(0))
+            r=np.array(shuffle(r,random_state=seed),dtype=int)
+            nvalid=int(pc_valid*len(r))
+            ivalid=torch.LongTensor(r[:nvalid])
+            itrain=torch.LongTensor(r[nvalid:])
+            task['valid']={}
+            task['valid']['x']=views.TensorView(task['train']['x'],ivalid,mean=mean,std=std)
+            task['valid']['y']=views.TensorView(task['train']['y'],ivalid)
+            task['train']['x']=views.TensorView(task['train']['x'],itrain,mean=mean,std=std)
+            task['train']['y']=views.TensorView(task['train']['y'],itrain)
+            task['test']['x']=views.TensorView(task['test']['x'],mean=mean,std=std)
+            yield i,task
+
+    return taskcla,size,tasks()
+
+def get(seed=0,pc_valid=0.10, tasknum = 10):
+    taskcla,size,tasks=stream(seed=seed,pc_valid=pc_valid,tasknum=tasknum)
+    data=dict(tasks)
+    data['ncla']=sum(ncla for t,ncla in taskcla)
+    return data,taskcla,size
@@ -1,70 +1,62 @@
 import os, sys
 import numpy as np
 import torch
+import utils
+from dataloaders import task_cache, views
 from torchvision import datasets, transforms
 from sklearn.utils import shuffle
 
 
-def get(seed=0, fixed_order=False, pc_valid=0, tasknum = 5):
+def stream(seed=0, fixed_order=False, pc_valid=0, tasknum = 5):
     if tasknum>5:
         tasknum = 5
-    data = {}
-    taskcla = []
     size = [1, 28, 28]
+    taskcla = [(t, 2) for t in range(tasknum)]
     
     # Pre-load
     # MNIST
     mean = (0.1307,)
     std = (0.3081,)
-    if not os.path.isdir('../dat/binary_split_mnist/'):
-        os.makedirs('../dat/binary_split_mnist')
+    cache_dir = '../dat/binary_split_mnist'
+    phash = task_cache.preprocessing_hash(dataset='mnist', tasks='split_mnist', dtype='uint8')
+    if not task_cache.is_complete(cache_dir, phash):
         dat = {}
-        dat['train'] = datasets.MNIST('../dat/', train=True, download=True, transform=transforms.Compose(
-            [transforms.Resize(28), transforms.ToTensor(),transforms.Normalize(mean,std)]))
-        dat['test'] = datasets.MNIST('../dat/', train=False, download=True, transform=transforms.Compose(
-            [transforms.Resize(28), transforms.ToTensor(),transforms.Normalize(mean,std)]))
+        dat['train'] = datasets.MNIST('../dat/', train=True, download=True)
+        dat['test'] = datasets.MNIST('../dat/', train=False, download=True)
+        tasks = {}
         for i in range(5):
-            data[i] = {}
-            data[i]['name'] = 'split_mnist-{:d}'.format(i)
-            data[i]['ncla'] = 2
-            data[i]['train'] = {'x': [], 'y': []}
-            data[i]['test'] = {'x': [], 'y': []}
+            tasks[i] = {'train': {}, 'test': {}}
         for s in ['train', 'test']:
-            loader = torch.utils.data.DataLoader(dat[s], batch_size=1, shuffle=False)
-            for image, target in loader:
-                task_idx = target.numpy()[0] // 2
-                data[task_idx][s]['x'].append(image)
-                data[task_idx][s]['y'].append(target.numpy()[0]%2)
+            images = utils.images_to_uint8(dat[s].data)
+            targets = torch.as_tensor(dat[s].targets).long()
+            for i in range(5):
+                task_mask = (targets // 2) == i
+                tasks[i][s]['x'] = images[task_mask]
+                tasks[i][s]['y'] = targets[task_mask] % 2
+        task_cache.write(cache_dir, tasks, phash)
 
-        for i in range(5):
-            for s in ['train', 'test']:
-                data[i][s]['x'] = torch.stack(data[i][s]['x']).view(-1,size[0],size[1],size[2])
-                data[i][s]['y'] = torch.LongTensor(np.array(data[i][s]['y'],dtype=int)).view(-1)
-                torch.save(data[i][s]['x'],os.path.join(os.path.expanduser('../dat/binary_split_mnist'), 'data'+ str(i) + s + 'x.bin'))
-                torch.save(data[i][s]['y'],os.path.join(os.path.expanduser('../dat/binary_split_mnist'), 'data'+ str(i) + s + 'y.bin'))
-    else:
-        # Load binary files
-        for i in range(5):
-            data[i] = dict.fromkeys(['name', 'ncla', 'train', 'test'])
-            data[i]['ncla'] = 2
-            data[i]['name'] = 'split_mnist-{:d}'.format(i)
+    def tasks():
+        # Open the memory-mapped tasks one at a time
+        manifest = task_cache.load_manifest(cache_dir)
+        for t in range(tasknum):
+            task = task_cache.open_task(cache_dir, t, manifest)
+            task['ncla'] = 2
+            task['name'] = 'split_mnist-{:d}'.format(t)
 
-            # Load
-            for s in ['train', 'test']:
-                data[i][s] = {'x': [], 'y': []}
-                data[i][s]['x'] = torch.load(os.path.join(os.path.expanduser('../dat/binary_split_mnist'), 'data'+ str(i) + s + 'x.bin'))
-                data[i][s]['y'] = torch.load(os.path.join(os.path.expanduser('../dat/binary_split_mnist'), 'data'+ str(i) + s + 'y.bin'))
-        
-    for t in range(tasknum):
-        data[t]['valid'] = {}
-        data[t]['valid']['x'] = data[t]['train']['x'].clone()
-        data[t]['valid']['y'] = data[t]['train']['y'].clone()
+            # The validation set is the training set, as a view of the same storage
+            # All splits keep the uint8 images and are normalised per batch
+            task['train']['x'] = views.TensorView(task['train']['x'], mean=mean, std=std)
+            task['test']['x'] = views.TensorView(task['test']['x'], mean=mean, std=std)
+            task['train']['y'] = views.TensorView(task['train']['y'])
+            task['valid'] = {}
+            task['valid']['x'] = task['train']['x']
+            task['valid']['y'] = task['train']['y']
+            yield t, task
 
-    # Others
-    n = 0
-    for t in range(tasknum):
-        taskcla.append((t, data[t]['ncla']))
-        n += data[t]['ncla']
-    data['ncla'] = n
-    
-    return data, taskcla, size
\ No newline at end of file
+    return taskcla, size, tasks()
+
+def get(seed=0, fixed_order=False, pc_valid=0, tasknum = 5):
+    taskcla, size, tasks = stream(seed=seed, fixed_order=fixed_order, pc_valid=pc_valid, tasknum=tasknum)
+    data = dict(tasks)
+    data['ncla'] = sum(ncla for t, ncla in taskcla)
+    return data, taskcla, size
@@ -1,100 +1,74 @@
 import os, sys
 import numpy as np
 import torch
+from dataloaders import h5_cache
 from torchvision import datasets, transforms
 from sklearn.utils import shuffle
-import h5py
 
 
 ########################################################################################################################
 
-def get(seed=0, fixed_order=False, pc_valid=0, tasknum = 50):
-    data = {}
-    taskcla = []
+def stream(seed=0, fixed_order=False, pc_valid=0, tasknum = 50):
     size = [1, 28, 28]
     tasknum = 50
 
-    if not os.path.isdir('../dat/binary_omniglot/'):
-        os.makedirs('../dat/binary_omniglot')
-        
-        filename = 'Permuted_Omniglot_task50.pt'
-        filepath = os.path.join(os.getcwd(), 'dataloaders')
+    cache_path = '../dat/omniglot.h5'
+    filename = 'Permuted_Omniglot_task50.pt'
+    filepath = os.path.join(os.getcwd(), 'dataloaders')
+    phash = h5_cache.preprocessing_hash(dataset='omniglot', source=filename, tasks=tasknum, split=[8, 1, 1])
+    if not h5_cache.is_complete(cache_path, phash):
 #         filepath = os.path.join(os.getcwd(), '')
         f = torch.load(os.path.join(filepath,filename))
         ncla_dict = {}
         for i in range(tasknum):
-            data[i] = {}
-            data[i]['name'] = 'omniglot-{:d}'.format(i)
-            data[i]['ncla'] = (torch.max(f['Y']['train'][i]) + 1).int().item()
-            ncla_dict[i] = data[i]['ncla']
-                
-                
-#                 loader = torch.utils.data.DataLoader(dat[s], batch_size=1, shuffle=False)
-            data[i]['train'] = {'x': [], 'y': []}
-            data[i]['test'] = {'x': [], 'y': []}
-            data[i]['valid'] = {'x': [], 'y': []}
+            ncla_dict[i] = (torch.max(f['Y']['train'][i]) + 1).int().item()
 
-            image = f['X']['train'][i]
-            target = f['Y']['train'][i]
+        def tasks():
+            # one task at a time is converted and written to the chunked store
+            for i in range(tasknum):
+                image = f['X']['train'][i]
+                target = f['Y']['train'][i]
 
-            index_arr = np.arange(len(image))
-            np.random.shuffle(index_arr)
-            train_ratio = (len(image)//10)*8
-            valid_ratio = (len(image)//10)*1
-            test_ratio = (len(image)//10)*1
-            
-            train_idx = index_arr[:train_ratio]
-            valid_idx = index_arr[train_ratio:train_ratio+valid_ratio]
-            test_idx = index_arr[train_ratio+valid_ratio:]
+                index_arr = np.arange(len(image))
+                np.random.shuffle(index_arr)
+                train_ratio = (len(image)//10)*8
+                valid_ratio = (len(image)//10)*1
+                test_ratio = (len(image)//10)*1
+                
+                train_idx = index_arr[:train_ratio]
+                valid_idx = index_arr[train_ratio:train_ratio+valid_ratio]
+                test_idx = index_arr[train_ratio+valid_ratio:]
 
-            data[i]['train']['x'] = image[train_idx]
-            data[i]['train']['y'] = target[train_idx]
-            data[i]['valid']['x'] = image[valid_idx]
-            data[i]['valid']['y'] = target[valid_idx]
-            data[i]['test']['x'] = image[test_idx]
-            data[i]['test']['y'] = target[test_idx]
-            
+                task = {}
+                for s, idx in [('train', train_idx), ('valid', valid_idx), ('test', test_idx)]:
+                    task[s] = {}
+                    task[s]['x'] = torch.as_tensor(image[idx])
+                    task[s]['y'] = torch.LongTensor(np.array(target[idx], dtype=int)).view(-1)
+                yield i, task
+        h5_cache.write(cache_path, tasks(), phash, meta={'ncla': ncla_dict})
+        del f
 
-            # "Unify" and save
-            for s in ['train', 'test', 'valid']:
-#                 data[i][s]['x'] = torch.stack(data[i][s]['x']).view(-1, size[0], size[1], size[2])
-                data[i][s]['y'] = torch.LongTensor(np.array(data[i][s]['y'], dtype=int)).view(-1)
-                torch.save(data[i][s]['x'],os.path.join(os.path.expanduser('../dat/binary_omniglot'), 'data' + str(i) + s + 'x.bin'))
-                torch.save(data[i][s]['y'],os.path.join(os.path.expanduser('../dat/binary_omniglot'), 'data' + str(i) + s + 'y.bin'))
-        torch.save(ncla_dict, os.path.join(os.path.expanduser('../dat/binary_omniglot'), 'ncla_dict.pt'))
+    # Open the tasks, batches are read from the HDF5 chunks when they are gathered
+    manifest = h5_cache.load_manifest(cache_path)
+#     ids=list(shuffle(np.arange(tasknum),random_state=seed))
+    ids=list(np.arange(tasknum))
+    print('Task order =',ids)
+    taskcla = [(i, manifest['meta']['ncla'][str(ids[i])]) for i in range(tasknum)]
+    for t, ncla in taskcla:
+        print('Task %d: %d classes'%(t+1,ncla))
+    print(sum(ncla for t, ncla in taskcla))
 
-    else:
-        
-        ncla_dict = torch.load(os.path.join(os.path.expanduser('../dat/binary_omniglot'), 'ncla_dict.pt'))
-        # Load binary files
-#         ids=list(shuffle(np.arange(tasknum),random_state=seed))
-        ids=list(np.arange(tasknum))
-        print('Task order =',ids)
+    def tasks():
         for i in range(tasknum):
-            data[i] = dict.fromkeys(['name', 'ncla', 'train', 'test','valid'])
-            data[i]['ncla'] = ncla_dict[ids[i]]
-            data[i]['name'] = 'omniglot-{:d}'.format(i)
-
-            # Load
-            for s in ['train', 'test', 'valid']:
-                data[i][s] = {'x': [], 'y': []}
-                data[i][s]['x'] = torch.load(os.path.join(os.path.expanduser('../dat/binary_omniglot'), 
-                                                          'data' + str(ids[i]) + s + 'x.bin'))
-                data[i][s]['y'] = torch.load(os.path.join(os.path.expanduser('../dat/binary_omniglot'), 
-                                                          'data' + str(ids[i]) + s + 'y.bin'))
+            task = h5_cache.open_task(cache_path, ids[i], manifest)
+            task['ncla'] = manifest['meta']['ncla'][str(ids[i])]
+            task['name'] = 'omniglot-{:d}'.format(i)
+            yield i, task
 
+    return taskcla, size, tasks()
 
-    # Others
-    n = 0
-    data_num = 0
-    for t in data.keys():
-        taskcla.append((t, data[t]['ncla']))
-        n += data[t]['ncla']
-        print('Task %d: %d classes'%(t+1,data[t]['ncla']))
-#         print(data[t]['train']['x'].shape[0])
-        data_num += data[t]['train']['x'].shape[0]
-    print(data_num)
-        
-    data['ncla'] = n
-    print(n)
-    return data, taskcla, 
\ No newline at end of file
+def get(seed=0, fixed_order=False, pc_valid=0, tasknum = 50):
+    taskcla, size, tasks = stream(seed=seed, fixed_order=fixed_order, pc_valid=pc_valid, tasknum=tasknum)
+    data = dict(tasks)
+    data['ncla'] = sum(ncla for t, ncla in taskcla)
+    return data, taskcla, size
@@ -0,0 +1,101 @@
+import os, json, hashlib, shutil
+import numpy as np
+import torch
+
+########################################################################################################################
+# On-disk task cache shared by the loaders.
+#
+# A cache is a directory with one flat .npy file per task, split and array, plus manifest.json recording the
+# shape and dtype of every array, the hash of the preprocessing that produced them and loader metadata.
+# It is written to a temporary directory, completed with a COMPLETE marker and then renamed into place, so a
+# directory without the marker or with a different preprocessing hash is never read and simply gets rebuilt.
+# Tasks are opened as copy-on-write memory maps: nothing is read until a page is touched.
+
+MANIFEST = 'manifest.json'
+COMPLETE = 'COMPLETE'
+VERSION = 1
+
+def preprocessing_hash(**kwargs):
+    kwargs['cache_version'] = VERSION
+    return hashlib.sha1(json.dumps(kwargs, sort_keys=True).encode()).hexdigest()
+
+def load_manifest(path):
+    with open(os.path.join(path, MANIFEST)) as f:
+        return json.load(f)
+
+def is_complete(path, phash):
+    if not os.path.isfile(os.path.join(path, COMPLETE)) or not os.path.isfile(os.path.join(path, MANIFEST)):
+        return False
+    try:
+        return load_manifest(path)['hash'] == phash
+    except (ValueError, KeyError):
+        return False
+
+def _save(path, arr):
+    with open(path, 'wb') as f:
+        np.save(f, arr)
+        f.flush()
+        os.fsync(f.fileno())
+
+def write(path, tasks, phash, meta=None):
+    """
+        Atomically write tasks = {task: {split: {name: tensor}}} to the cache directory path.
+        meta is any json-serialisable loader metadata, returned by load_manifest(path)['meta'].
+    """
+    path = os.path.normpath(path)
+    tmp = '{}.tmp-{}'.format(path, os.getpid())
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    manifest = {'hash': phash, 'meta': meta if meta is not None else {}, 'tasks': {}}
+    for t, splits in tasks.items():
+        manifest['tasks'][str(t)] = {}
+        for s, arrays in splits.items():
+            manifest['tasks'][str(t)][s] = {}
+            for name, tensor in arrays.items():
+                arr = np.ascontiguousarray(torch.as_tensor(tensor).numpy())
+                filename = 'task{}_{}_{}.npy'.format(t, s, name)
+                _save(os.path.join(tmp, filename), arr)
+                manifest['tasks'][str(t)][s][name] = {'file': filename, 'shape': list(arr.shape), 'dtype': arr.dtype.str}
+
+    with open(os.path.join(tmp, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    with open(os.path.join(tmp, COMPLETE), 'w') as f:
+        f.flush()
+        os.fsync(f.fileno())
+
+    # another process may have finished the same cache in the meantime
+    if is_complete(path, phash):
+        shutil.rmtree(tmp)
+        return
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        if not is_complete(path, phash):
+            raise
+        shutil.rmtree(tmp)
+
+def open_task(path, t, manifest=None):
+    """
+        Open task t of a complete cache as {split: {name: tensor}} of zero-copy memory-mapped tensors.
+    """
+    if manifest is None:
+        manifest = load_manifest(path)
+    task = {}
+    for s, arrays in manifest['tasks'][str(t)].items():
+        task[s] = {}
+        for name, entry in arrays.items():
+            # copy-on-write keeps the tensor writable without ever touching the file
+            arr = np.load(os.path.join(path, entry['file']), mmap_mode='c')
+            if list(arr.shape) != entry['shape'] or arr.dtype.str != entry['dtype']:
+                raise ValueError('{} does not match the manifest of {}, delete the directory to rebuild it'.format(entry['file'], path))
+            task[s][name] = torch.from_numpy(arr)
+    return task
+
+def task_ids(manifest):
+    return sorted(int(t) for t in manifest['tasks'].keys())
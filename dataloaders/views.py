@@ -0,0 +1,326 @@
+import torch
+from collections import OrderedDict
+
+########################################################################################################################
+# Lazily gathered datasets.
+#
+# The approaches only ever index their inputs with a batch of indices (x[b]) and ask for their size, so a loader
+# can hand out a TensorView instead of a materialised tensor. The view keeps a reference to shared storage, an
+# optional index selecting its rows, and applies the per-task transformation to each gathered batch only.
+# Images are stored as raw uint8 and normalised batch by batch on the device the storage lives on.
+
+class TensorView(object):
+    def __init__(self, storage, index=None, perm=None, mean=None, std=None, cast=None):
+        """
+            :param storage: N x ... tensor, possibly shared with other splits and tasks
+            :param index: optional LongTensor of the storage rows in this view, None for all of them
+            :param perm: optional LongTensor permuting the flattened features of each gathered batch
+            :param mean, std: optional per-channel statistics, the uint8 storage is then gathered as
+                              (x/255 - mean)/std like transforms.ToTensor and transforms.Normalize
+            :param cast: optional dtype the gathered batches are converted to, for storage kept in a compact dtype
+        """
+        self.storage = storage
+        self.index = index
+        self.perm = perm
+        if mean is not None:
+            mean = torch.as_tensor(mean, dtype=torch.float32, device=storage.device).view(1, -1, *([1]*(storage.dim()-2)))
+            std = torch.as_tensor(std, dtype=torch.float32, device=storage.device).view(1, -1, *([1]*(storage.dim()-2)))
+        self.mean = mean
+        self.std = std
+        self.cast = cast
+
+    def __getitem__(self, b):
+        if self.index is not None:
+            b = self.index[b]
+        x = self.storage[b]
+        if self.mean is not None:
+            x = x.float().div_(255).sub_(self.mean).div_(self.std)
+        if self.perm is not None:
+            x = x.reshape(x.size(0), -1).index_select(1, self.perm).view(x.shape)
+        if self.cast is not None:
+            x = x.to(self.cast)
+        return x
+
+    def __len__(self):
+        if self.index is None:
+            return self.storage.size(0)
+        return self.index.size(0)
+
+    def size(self, dim=None):
+        if dim is None:
+            return self.shape
+        return self.shape[dim]
+
+    @property
+    def shape(self):
+        return torch.Size([len(self)]) + self.storage.shape[1:]
+
+    @property
+    def dtype(self):
+        if self.cast is not None:
+            return self.cast
+        return torch.float32 if self.mean is not None else self.storage.dtype
+
+    @property
+    def device(self):
+        return self.storage.device
+
+    def to(self, device):
+        return to_device([self], device)[0]
+
+    def materialise(self):
+        return self[torch.arange(len(self), device=self.device)]
+
+    def rows(self):
+        # storage rows covered by the view
+        if self.index is None:
+            return torch.arange(self.storage.size(0), device=self.device)
+        return self.index
+
+
+def to_device(tensors, device):
+    """
+        Move tensors and views to device, copying storage that several of them share only once.
+    """
+    moved = {}
+    def move(x):
+        if x is None:
+            return None
+        if id(x) not in moved:
+            moved[id(x)] = (x, x.to(device))
+        return moved[id(x)][1]
+
+    out = []
+    for x in tensors:
+        if isinstance(x, TensorView):
+            out.append(TensorView(move(x.storage), move(x.index), move(x.perm), move(x.mean), move(x.std), x.cast))
+        else:
+            out.append(move(x))
+    return out
+
+class DeviceCache(object):
+    def __init__(self, device, budget=0, dtype=None):
+        """
+            to_device for datasets that are moved again and again, e.g. the test sets of the tasks seen so far:
+            the moved tensors stay resident and later calls reuse them instead of copying.
+            Everything used together should be moved in one call. The budget bounds what stays resident between
+            calls, not the peak within one: the tensors of a call are all returned, and those beyond the budget are
+            only dropped afterwards, least recently used first, so the next call copies just the part that did not fit.
+            :param device: device the tensors and views are moved to
+            :param budget: bytes kept resident between calls; 0 keeps nothing
+            :param dtype: optional compact floating dtype of cached floating point data, the gathered batches are
+                          converted back to the original dtype
+        """
+        self.device = torch.device(device)
+        self.budget = budget
+        self.dtype = dtype
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def __call__(self, tensors):
+        def move(x, data=False):
+            if x is None:
+                return None
+            if id(x) in self.entries:
+                self.entries.move_to_end(id(x))
+            else:
+                #the source is kept in the entry so that its id is not reused while the entry lives
+                moved = self.compact(x.to(self.device) if isinstance(x, torch.Tensor) else x.to(self.device).materialise(), data)
+                self.entries[id(x)] = (x, moved, moved.numel() * moved.element_size())
+                self.nbytes += self.entries[id(x)][2]
+            return self.entries[id(x)][1]
+
+        out = []
+        for x in tensors:
+            if isinstance(x, TensorView):
+                storage = move(x.storage, data=x.mean is None)
+                cast = x.storage.dtype if x.cast is None and storage.dtype != x.storage.dtype else x.cast
+                out.append(TensorView(storage, move(x.index), move(x.perm), move(x.mean), move(x.std), cast))
+            else:
+                # plain tensors and datasets read from disk (h5_cache.H5View), the latter are read once into memory
+                moved = move(x, data=True)
+                out.append(TensorView(moved, cast=x.dtype) if moved.dtype != x.dtype else moved)
+
+        # least recently used first, the tensors returned by this call stay valid after being dropped
+        while self.entries and self.nbytes > max(self.budget, 0):
+            self.nbytes -= self.entries.popitem(last=False)[1][2]
+        return out
+
+    def compact(self, x, data):
+        if data and self.dtype is not None and x.is_floating_point():
+            return x.to(self.dtype)
+        return x
+
+def merge(splits):
+    """
+        Concatenate [(x, y), ...] splits along the batch dimension.
+        When all of them are views of the same storage, the result is a view over the union of their rows:
+        examples present in several splits are kept once and nothing is copied.
+    """
+    xs = [x for x, y in splits]
+    ys = [y for x, y in splits]
+    if _shared(xs) and _shared(ys):
+        rows = torch.unique(torch.cat([x.rows() for x in xs]))
+        if rows.size(0) == xs[0].storage.size(0):
+            rows = None
+        return _like(xs[0], xs[0].storage, rows), _like(ys[0], ys[0].storage, rows)
+    return cat(xs), cat(ys)
+
+def cat(tensors):
+    """
+        torch.cat along the batch dimension for tensors and TensorViews.
+        Views with the same permutation and normalisation stay a view, anything else is gathered into a plain tensor.
+        Other lazy datasets with a cat staticmethod (h5_cache.H5View) concatenate themselves when they can.
+    """
+    if hasattr(type(tensors[0]), 'cat'):
+        out = type(tensors[0]).cat(tensors)
+        if out is not None:
+            return out
+    if all(isinstance(x, TensorView) and _same_transform(x, tensors[0]) for x in tensors):
+        return _like(tensors[0], torch.cat([x.storage if x.index is None else x.storage[x.index] for x in tensors], dim=0))
+    return torch.cat([x.materialise() if isinstance(x, TensorView) else x for x in tensors], dim=0)
+
+def _like(view, storage, index=None):
+    return TensorView(storage, index, view.perm, view.mean, view.std, view.cast)
+
+def _shared(tensors):
+    return all(isinstance(x, TensorView) and x.storage is tensors[0].storage and _same_transform(x, tensors[0]) for x in tensors)
+
+def _same_transform(x, y):
+    return _same(x.perm, y.perm) and _same(x.mean, y.mean) and _same(x.std, y.std) and x.cast == y.cast
+
+def _same(a, b):
+    if a is None or b is None:
+        return a is b
+    return a is b or torch.equal(a, b)
+
+def batches(x, y, r, sbatch):
+    """
+        Iterate (i, b, x[b], y[b]) over the consecutive batches b=r[i:i+sbatch] of the index r.
+        Datasets that can read ahead (h5_cache.H5View) gather the next batches in the background.
+    """
+    index = [(i, r[i:i+sbatch]) for i in range(0, len(r), sbatch)]
+    if hasattr(x, 'prefetch'):
+        gathered = x.prefetch([y], [b for i, b in index])
+    else:
+        gathered = ([x[b], y[b]] for i, b in index)
+    for (i, b), (xb, yb) in zip(index, gathered):
+        yield i, b, xb, yb
+
+def task_batches(sets, tasks, sbatch):
+    """
+        Iterate (x, y, task_labels, segments) over batches of sbatch consecutive examples of the concatenated sets,
+        sets[k] = (x, y) holding the examples of task tasks[k]. A batch can span several tasks, task_labels gives
+        the task of each of its rows and segments the (task, start, stop) row ranges of each task on the host.
+    """
+    pending, count = [], 0
+    for task, (x, y) in zip(tasks, sets):
+        start = 0
+        while start < len(x):
+            stop = min(len(x), start + sbatch - count)
+            pending.append((task, _slice(x, start, stop), _slice(y, start, stop)))
+            count += stop - start
+            start = stop
+            if count == sbatch:
+                yield _join(pending)
+                pending, count = [], 0
+    if pending:
+        yield _join(pending)
+
+def _slice(x, start, stop):
+    if isinstance(x, torch.Tensor):
+        return x[start:stop]
+    return x[torch.arange(start, stop, device=x.device)]
+
+def _join(pending):
+    xs = torch.cat([x for task, x, y in pending]) if len(pending) > 1 else pending[0][1]
+    ys = torch.cat([y for task, x, y in pending]) if len(pending) > 1 else pending[0][2]
+    task_labels = torch.cat([torch.full((len(y),), task, dtype=torch.long, device=ys.device) for task, x, y in pending])
+    segments, start = [], 0
+    for task, x, y in pending:
+        segments.append((task, start, start + len(y)))
+        start += len(y)
+    return xs, ys, task_labels, segments
+
+# rows gathered at a time from views that transform their batches, when the whole epoch is gathered at once
+TRANSFORM_CHUNK = 4096
+
+def gather(x, b, out):
+    # x[b] written into the preallocated out
+    if isinstance(x, torch.Tensor):
+        return torch.index_select(x, 0, b, out=out)
+    if isinstance(x, TensorView) and x.perm is None and x.cast is None:
+        rows = b if x.index is None else x.index[b]
+        if x.mean is None:
+            return torch.index_select(x.storage, 0, rows, out=out)
+        # normalised in place in out, as TensorView.__getitem__ does, the gathered uint8 rows are the only temporary
+        out.copy_(x.storage.index_select(0, rows))
+        return out.div_(255).sub_(x.mean).div_(x.std)
+    return out.copy_(x[b])
+
+def _transforms(x):
+    return not isinstance(x, torch.Tensor) and not (isinstance(x, TensorView) and x.mean is None and x.perm is None and x.cast is None)
+
+
+class EpochIterator(object):
+    def __init__(self, seed=0, chunk=0):
+        """
+            Hands out the batches of an epoch as slices of one contiguous buffer.
+            :param seed: seed of the per-device generators drawing the epoch permutations
+            :param chunk: rows gathered at a time into the buffer, 0 gathers the whole epoch at once
+                          except from views transforming their batches, which go by TRANSFORM_CHUNK rows
+                          so that their temporaries stay bounded
+        """
+        self.seed = seed
+        self.chunk = chunk
+        self.generators = {}
+        self.buffers = {}
+
+    def generator(self, device):
+        device = torch.device(device)
+        if device not in self.generators:
+            self.generators[device] = torch.Generator(device=device).manual_seed(self.seed)
+        return self.generators[device]
+
+    def buffer(self, key, n, x):
+        # grown to the largest dataset seen so far and reused for every epoch and task
+        shape = tuple(x.shape[1:])
+        k = (key, x.dtype, shape, str(x.device))
+        if k not in self.buffers or self.buffers[k].size(0) < n:
+            self.buffers.pop(k, None)
+            self.buffers[k] = torch.empty((n,) + shape, dtype=x.dtype, device=x.device)
+        return self.buffers[k][:n]
+
+    def fill(self, key, x, r):
+        out = self.buffer(key, len(r), x)
+        step = self.chunk if self.chunk > 0 else TRANSFORM_CHUNK if _transforms(x) else len(r)
+        for i in range(0, len(r), step):
+            gather(x, r[i:i+step], out[i:i+step])
+        return out
+
+    def __call__(self, x, y, sbatch, shuffle=True, pad=False):
+        """
+            Iterate (i, b, x[b], y[b]) over the batches b=r[i:i+sbatch] of an epoch, r being a random permutation
+            when shuffle is set and the identity otherwise.
+            With pad, every x[b], y[b] has sbatch rows: the last batch is completed with repeated examples,
+            its first len(b) rows are the real ones.
+        """
+        n = x.size(0)
+        if shuffle:
+            r = torch.randperm(n, generator=self.generator(x.device), device=x.device)
+        else:
+            r = torch.arange(n, device=x.device)
+        if hasattr(x, 'prefetch') and not pad:
+            # datasets read from disk keep gathering a bounded number of batches at a time
+            yield from batches(x, y, r, sbatch)
+            return
+        if not shuffle and not pad and isinstance(x, torch.Tensor) and isinstance(y, torch.Tensor):
+            xs, ys = x, y
+        else:
+            rows = r
+            if pad and n % sbatch != 0:
+                m = (n // sbatch + 1) * sbatch
+                rows = r.repeat(m // n + 1)[:m]
+            xs, ys = self.fill('x', x, rows), self.fill('y', y, rows)
+        for i in range(0, n, sbatch):
+            yield i, r[i:i+sbatch], xs[i:i+sbatch], ys[i:i+sbatch]
@@ -18,6 +18,46 @@ import math
 import numpy as np
 from torch.nn import init
 from functools import partial
+from networks.moments import Moments, split
+
+def task_log_alpha(module, task_labels):
+    # the log_alpha row of every example, or a single row broadcast over the batch when task_labels is an int
+    if isinstance(task_labels, int):
+        return module.log_alpha[task_labels]
+    return F.embedding(task_labels, module.log_alpha)
+
+def dropout_kl(log_alpha):
+    # Kingma's approximation of the KL-divergence summed over the entries of log_alpha, of any shape
+    c1 = 1.16145124
+    c2 = -1.50204118
+    c3 = 0.58629921
+    alpha = (2 * log_alpha).exp()         # log_alpha is clipped to be less equal than zero by project()
+    negative_kl = log_alpha + alpha * (c1 + alpha * (c2 + c3 * alpha))
+    return -negative_kl.sum()
+
+def dropout_moments(x, alpha):
+    # x times independent N(1, alpha**2) noise keeps the mean, x is a Moments or a tensor of zero variance
+    mean, var = split(x)
+    var_noise = mean**2 * alpha**2
+    if var is not None:
+        var_noise = var_noise + var * (1 + alpha**2)
+    return Moments(mean, var_noise)
+
+def standard_normal(module, shape, device):
+    """
+        N(0, 1) noise of the given shape drawn on device from a generator seeded per module, written into a buffer
+        of the module that is reused from batch to batch. Under torch.compile the draw uses the global generator
+        and is fused by the compiler instead.
+    """
+    if torch.compiler.is_compiling():
+        return torch.randn(shape, device=device)
+    device = torch.device(device)
+    if device not in module.generators:
+        module.generators[device] = torch.Generator(device=device).manual_seed(module.seed)
+    n = math.prod(shape)
+    if module.noise is None or module.noise.device != device or module.noise.numel() < n:
+        module.noise = torch.empty(n, device=device)
+    return module.noise[:n].view(shape).normal_(generator=module.generators[device])
 
 class GaussDropout(nn.Module):
     def __init__(self, tasks, input_size, p=0.5):
@@ -32,20 +72,31 @@ class GaussDropout(nn.Module):
         self.p = p      
         self.input_size = input_size
         self.max_alpha = 1.0
+        self.mode = 'sample'
         self.log_alpha = nn.Parameter(torch.Tensor(tasks, self.input_size))
+        #noise generator seeded from the global one, one per device, and the reused noise buffer
+        self.seed = int(torch.randint(2**62, []))
+        self.generators = {}
+        self.noise = None
         self.reset_parameters()
     
     def reset_parameters(self):
         alpha = math.sqrt(self.p/(1-self.p))
         init.constant_(self.log_alpha, math.log(alpha))
+        self.project()
+
+    @torch.no_grad()
+    def project(self):
+        # alpha < max_alpha, enforced after every optimizer step instead of at the start of forward
+        self.log_alpha.clamp_(max= math.log(self.max_alpha - 1e-6))
 
     def forward(self, x, task_labels, num_samples=1):
-        # x.shape = [num_samples, batch_size, input_size]
-        self.log_alpha.data = torch.clamp(self.log_alpha.data, max= math.log(self.max_alpha - 1e-6))
-        log_alpha = F.embedding(task_labels, self.log_alpha)
-        epsilon = torch.randn(x.size()) 
-        if x.is_cuda:
-            epsilon = epsilon.cuda()
+        # x.shape = [num_samples, batch_size, input_size], or [1, batch_size, input_size] when the samples
+        # have not been drawn yet, the noise then replicates x num_samples times
+        log_alpha = task_log_alpha(self, task_labels)
+        if self.mode == 'moments':
+            return dropout_moments(x, torch.exp(log_alpha).view(1, -1, self.input_size))
+        epsilon = standard_normal(self, (num_samples,) + x.shape[1:], x.device)
         
         #log_alpha.data = torch.clamp(log_alpha.data, max= math.log(self.max_alpha - 1e-6))
         alpha = torch.exp(log_alpha)
@@ -53,7 +104,8 @@ class GaussDropout(nn.Module):
 
         # input vectors have the same alpha vector
         # each feature in each input vector has particular alpha_{i} 
-        epsilon = epsilon * alpha + 1
+        # 1 + epsilon * alpha in one kernel
+        epsilon = torch.addcmul(x.new_ones(()), epsilon, alpha)
 
         
         return x * epsilon  
@@ -64,16 +116,7 @@ class GaussDropout(nn.Module):
             This approximated KL is calculated follow the Kingma's paper
             https://arxiv.org/abs/1506.02557
         """
-        task = torch.tensor([task]).cuda()
-        log_alpha = F.embedding(task, self.log_alpha)
-        c1 = 1.16145124
-        c2 = -1.50204118
-        c3 = 0.58629921
-        alpha = (2 * log_alpha).exp()         # self.log_alpha was clipped to ensure less equal than zero   
-        negative_kl = log_alpha + c1*alpha + c2*alpha**2 + c3*alpha**3          
-        kl = -negative_kl
-        
-        return kl.sum()   
+        return dropout_kl(self.log_alpha[task])
  
 
 class GaussDropoutConv2d(nn.Module):
@@ -90,29 +133,45 @@ class GaussDropoutConv2d(nn.Module):
         self.in_channels = in_channels
         self.size = size
         self.max_alpha = 1.0
+        self.mode = 'sample'
         self.log_alpha = nn.Parameter(torch.Tensor(tasks, in_channels * self.size * self.size))
+        #noise generator seeded from the global one, one per device, and the reused noise buffer
+        self.seed = int(torch.randint(2**62, []))
+        self.generators = {}
+        self.noise = None
         self.reset_parameters()
     
     def reset_parameters(self):
         alpha = math.sqrt(self.p/(1-self.p))
         init.constant_(self.log_alpha, math.log(alpha))
+        self.project()
+
+    @torch.no_grad()
+    def project(self):
+        # alpha < max_alpha, enforced after every optimizer step instead of at the start of forward
+        self.log_alpha.clamp_(max= math.log(self.max_alpha - 1e-6))
 
     def forward(self, x, task_labels, num_samples=1):
         # x.shape = [batch_size, channel, h, w]
-        self.log_alpha.data = torch.clamp(self.log_alpha.data, max= math.log(self.max_alpha - 1e-6))
-        log_alpha = F.embedding(task_labels, self.log_alpha)
-        epsilon = torch.randn(x.size()) 
-        if x.is_cuda:
-            epsilon = epsilon.cuda()
+        log_alpha = task_log_alpha(self, task_labels)
+        if isinstance(task_labels, int):
+            shape = [1, self.in_channels, self.size, self.size]
+        else:
+            shape = [-1, self.in_channels, self.size, self.size]
+        if self.mode == 'moments':
+            return dropout_moments(x, torch.exp(log_alpha).reshape(shape))
+        epsilon = standard_normal(self, x.shape, x.device)
         
         # log_alpha.data = torch.clamp(log_alpha.data, max= math.log(self.max_alpha - 1e-6))
-        alpha = torch.exp(log_alpha)
-        alpha = alpha.reshape([x.shape[0]//num_samples, self.in_channels, self.size, self.size]).repeat(num_samples, 1,1,1)
+        alpha = torch.exp(log_alpha).reshape(shape)
+        if not isinstance(task_labels, int):
+            alpha = alpha.repeat(num_samples, 1,1,1)
 
 
         # input vectors have the same alpha vector
         # each feature in each input vector has particular alpha_{i} 
-        epsilon = epsilon * alpha + 1
+        # 1 + epsilon * alpha in one kernel
+        epsilon = torch.addcmul(x.new_ones(()), epsilon, alpha)
         
         return x * epsilon  
     
@@ -124,14 +183,4 @@ class GaussDropoutConv2d(nn.Module):
             This approximated KL is calculated follow the Kingma's paper
             https://arxiv.org/abs/1506.02557
         """
-        task = torch.tensor([task]).cuda()
-        log_alpha = F.embedding(task, self.log_alpha)
-        c1 = 1.16145124
-        c2 = -1.50204118
-        c3 = 0.58629921
-        alpha = (2 * log_alpha).exp()         # self.log_alpha was clipped to ensure less equal than zero   
-        negative_kl = log_alpha + c1*alpha + c2*alpha**2 + c3*alpha**3          
-        kl = -negative_kl
-
-        
-        return kl.sum() 
\ No newline at end of file
+        return dropout_kl(self.log_alpha[task])
\ No newline at end of file
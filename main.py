@@ -1,4 +1,5 @@
 import sys,os,argparse,time
+from copy import deepcopy
 import numpy as np
 import torch
 
@@ -6,39 +7,8 @@ from best_hyperparams import get_best_params
 from utils import *
 import utils
 from arguments import get_args
-args = get_args()
-
-tstart=time.time()
-
-film=0
-single_head = 0
-if args.film:
-    film = 1
-if args.single_head:
-    single_head = 1
-best_param, best_lr, best_epochs = get_best_params(args.approach, args.experiment)
-if len(args.parameter) == 0:
-    params = best_param.split(',')
-elif len(args.parameter)>=1:
-    params=args.parameter.split(',')
-beta= float(params[0])
-lamb= float(params[1])
-
-
-if args.approach == 'gvclf':
-    log_name = '{}_{}_{}_film_{}_beta_{}_lamb_{}_woDr_{}_lr_{}_batch_{}_epoch_{}_singlehead_{}_prior_var_{}'.format(args.experiment, args.approach,args.seed,
-                                                                    film, beta, lamb, 
-                                                                    args.wo_Dropout, args.lr, args.batch_size, args.nepochs, single_head, args.prior_var)
-
-
-elif args.approach == 'gvclf_vd':
-    log_name = '{}_{}_{}_film_{}_KLweight_{}_dr_{}_beta_{}_lamb_{}_KLcoeff_{}_samples_{}_conv_Dropout_{}_droptype_{}_lr_{}_batch_{}_epoch_{}_singlehead_{}_prior_var_{}'.format(
-                                                                args.experiment, args.approach,args.seed, 
-                                                                film, args.KL_weight, args.droprate, beta, lamb,
-                                                                args.KL_coeff, 
-                                                                args.num_samples, args.conv_Dropout, args.drop_type,
-                                                                args.lr,
-                                                                args.batch_size, args.nepochs, single_head, args.prior_var)
+from dataloaders import views
+
 conv_experiment = [
     'split_cifar10',
     'split_cifar100',
@@ -51,340 +21,436 @@ conv_experiment = [
     'mixture'
 ]
 
-if args.experiment in conv_experiment:
-    args.conv = True
-    log_name = log_name + '_conv'
+########################################################################################################################
 
-if args.output=='':
-    args.output = './result_data/' + args.experiment + '/' + args.approach + '/' + log_name + '.txt'
-print('='*100)
-print('Arguments =')
-for arg in vars(args):
-    print('\t'+arg+':',getattr(args,arg))
-print('='*100)
+def get_dataloader(experiment):
+    if experiment=='mnist2':
+        from dataloaders import mnist2 as dataloader
+    elif experiment=='pmnist':
+        from dataloaders import pmnist as dataloader
+    elif experiment=='cifar':
+        from dataloaders import cifar as dataloader
+    elif experiment=='mixture':
+        from dataloaders import mixture as dataloader
+    elif experiment=='easy-chasy':
+        from dataloaders import easy_chasy as dataloader
+    elif experiment=='hard-chasy':
+        from dataloaders import hard_chasy as dataloader
+    elif experiment=='smnist':
+        from dataloaders import smnist as dataloader
+    elif experiment=='split_mnist':
+        from dataloaders import split_mnist as dataloader
+    elif experiment == 'split_cifar100':
+        from dataloaders import split_cifar100 as dataloader
+    elif experiment == 'split_cifar10_100':
+        from dataloaders import split_cifar10_100 as dataloader
+    elif experiment == 'omniglot':
+        from dataloaders import split_omniglot as dataloader
+    elif experiment == 'pmnist':
+        from dataloaders import pmnist as dataloader
+    return dataloader
+
+def get_approach(approach):
+    if approach=='random':
+        from approaches import random as approach
+    elif approach=='sgd':
+        from approaches import sgd as approach
+    elif approach=='sgd-restart':
+        from approaches import sgd_restart as approach
+    elif approach=='sgd-frozen':
+        from approaches import sgd_frozen as approach
+    elif approach=='lwf':
+        from approaches import lwf as approach
+    elif approach=='lfl':
+        from approaches import lfl as approach
+    elif approach=='ewc':
+        from approaches import ewc as approach
+    elif approach=='ewc-film':
+        from approaches import ewc_film as approach
+    elif approach=='ewc2':
+        from approaches import ewc2 as approach
+    elif approach=='imm-mean':
+        from approaches import imm_mean as approach
+    elif approach=='imm-mode':
+        from approaches import imm_mode as approach
+    elif approach=='progressive':
+        from approaches import progressive as approach
+    elif approach=='pathnet':
+        from approaches import pathnet as approach
+    elif approach=='hat-test':
+        from approaches import hat_test as approach
+    elif approach=='hat':
+        from approaches import hat as approach
+    elif 'gvclf_vd' == approach:
+        from approaches import gvclf_vd as approach
+    elif 'gvclf' == approach:
+        from approaches import gvclf as approach
+    elif approach=='joint':
+        from approaches import joint as approach
+    elif 'vcl' in approach:
+        from approaches import gvclf as approach
+    return approach
+
+def get_network(experiment, approach):
+    if experiment=='mnist2' or experiment=='pmnist':
+        if approach=='hat' or approach=='hat-test':
+            from networks import mlp_hat as network
+        elif 'gvclf' == approach:
+            from networks.gvcl_models import MLPFilm as network
+        elif 'gvclf_vd' in approach:
+            from networks.gvcl_models import MLPFilmVD as network
+        else:
+            from networks import mlp as network
+    elif experiment == 'mixture':
+        if approach=='lfl':
+            from networks import alexnet_lfl as network
+        elif approach=='hat':
+            from networks import alexnet_hat as network
+        elif approach=='progressive':
+            from networks import alexnet_progressive as network
+        elif approach=='pathnet':
+            from networks import alexnet_pathnet as network
+        elif approach=='ewc-film':
+            from networks import alexnet_ewc_film as network
+        elif approach=='hat-test':
+            from networks import alexnet_hat_test as network
+        elif 'vclf' in approach:
+            from networks.gvcl_models import AlexNetFiLM as network
+        elif 'vcl' in approach:
+            from networks.gvcl_models import AlexNetNoFiLM as network
+        else:
+            from networks import alexnet as network
+
+
+
+    elif experiment == 'cifar' or experiment == 'split_cifar100' or experiment == 'split_cifar10_100':
+        if approach=='lfl':
+            from networks import zenkenet_lfl as network
+        elif approach=='hat':
+            from networks import zenkenet_hat as network
+        elif approach=='progressive':
+            from networks import zenkenet_progressive as network
+        elif approach=='pathnet':
+            from networks import zenkenet_pathnet as network
+        elif approach=='hat-test':
+            from networks import zenkenet_hat_test as network
+        elif approach=='ewc-film':
+            from networks import zenkenet_ewc_film as network
+        elif 'gvclf' == approach:
+            from networks.gvcl_models import CNNFilm as network
+        elif 'gvclf_vd' == approach:
+            from networks.gvcl_models import CNNFilmVD as network
+        elif 'gvcl' == approach:
+            from networks.gvcl_models import ZenkeNetNoFiLM as network
+        else:   
+            from networks import zenkenet as network
+
+    elif 'chasy' in experiment:
+        if approach=='lfl':
+            from networks import babynet_lfl as network
+        elif approach=='hat':
+            from networks import babynet_hat as network
+        elif approach=='progressive':
+            from networks import babynet_progressive as network
+        elif approach=='pathnet':
+            from networks import babynet_pathnet as network
+        elif approach=='ewc-film':
+            from networks import babynet_ewc_film as network
+        elif 'vclf' in approach:
+            from networks.gvcl_models import BabyNetFiLM as network
+        elif 'vcl' in approach:
+            from networks.gvcl_models import BabyNetNoFiLM as network
+        else:
+            from networks import babynet as network
+
+    elif 'smnist' == experiment or 'split_mnist' == experiment:
+        if approach=='lfl':
+            from networks import smnistnet_lfl as network
+        elif approach=='hat':
+            from networks import smnistnet_hat as network
+        elif approach=='progressive':
+            from networks import smnistnet_progressive as network
+        elif approach=='pathnet':
+            from networks import smnistnet_pathnet as network
+        elif approach=='hat-test':
+            from networks import smnistnet_hat_test as network
+        elif approach=='ewc-film':
+            from networks import smnistnet_ewc_film as network
+        elif approach=='ewc2':
+            from networks import smnistnet_binary as network
+        elif 'gvclf' == approach:
+            from networks.gvcl_models import MLPFilm as network
+        elif 'gvclf_vd' in approach:
+            from networks.gvcl_models import MLPFilmVD as network
+        else:
+            from networks import smnistnet as network
+
+    elif experiment == 'omniglot':
+        if 'gvclf' == approach:
+            from networks.gvcl_models import CNNOmniglotFilm as network
+        elif 'gvclf_vd' in approach:
+            from networks.gvcl_models import CNNOmniglotFilmVD as network
+    return network
+
+def get_device(args):
+    if args.device == 'auto':
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if args.device.startswith('cuda') and not torch.cuda.is_available():
+        raise RuntimeError('--device {} requested but CUDA is unavailable'.format(args.device))
+    device = torch.device(args.device)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    if args.num_interop_threads > 0 and args.num_interop_threads != torch.get_num_interop_threads():
+        #can only be set once per process, before any inter-op parallel work
+        torch.set_num_interop_threads(args.num_interop_threads)
+    print('Device = {}, threads = {} intra-op / {} inter-op'.format(device, torch.get_num_threads(), torch.get_num_interop_threads()))
+    return device
+
+def get_taskcla(data):
+    return [(t,data[t]['ncla']) for t in data.keys() if t != 'ncla']
+
+def load_data(args):
+    # the returned dict is only read by run_experiment, so it can be shared by many runs
+    print('Load data...')
+    kwargs={} if args.ntasks == -1 else {'tasknum': args.ntasks}
+    data,taskcla,inputsize=get_dataloader(args.experiment).get(seed=args.seed,**kwargs)
+    return data
+
+def stream_data(args, data=None):
+    # taskcla and the input size up front, then the tasks one at a time as (t, task dict)
+    if data is not None:
+        taskcla=get_taskcla(data)
+        return taskcla,list(data[0]['train']['x'].shape[1:]),((t,data[t]) for t,ncla in taskcla)
+    print('Load data...')
+    kwargs={} if args.ntasks == -1 else {'tasknum': args.ntasks}
+    taskcla,inputsize,tasks=get_dataloader(args.experiment).stream(seed=args.seed,**kwargs)
+    return taskcla,list(inputsize),tasks
 
 ########################################################################################################################
-if not os.path.isdir('./result_data/'+ args.experiment + '/' + args.approach + '/'):
-    os.makedirs('./result_data/'+ args.experiment + '/' + args.approach + '/')
-
-# Seed
-np.random.seed(args.seed)
-torch.manual_seed(args.seed)
-if torch.cuda.is_available(): 
-    torch.cuda.manual_seed(args.seed)
-else: 
-    print('[CUDA unavailable]'); sys.exit()
-
-# Args -- Experiment
-if args.experiment=='mnist2':
-    from dataloaders import mnist2 as dataloader
-elif args.experiment=='pmnist':
-    from dataloaders import pmnist as dataloader
-elif args.experiment=='cifar':
-    from dataloaders import cifar as dataloader
-elif args.experiment=='mixture':
-    from dataloaders import mixture as dataloader
-elif args.experiment=='easy-chasy':
-    from dataloaders import easy_chasy as dataloader
-elif args.experiment=='hard-chasy':
-    from dataloaders import hard_chasy as dataloader
-elif args.experiment=='smnist':
-    from dataloaders import smnist as dataloader
-elif args.experiment=='split_mnist':
-    from dataloaders import split_mnist as dataloader
-elif args.experiment == 'split_cifar100':
-    from dataloaders import split_cifar100 as dataloader
-elif args.experiment == 'split_cifar10_100':
-    from dataloaders import split_cifar10_100 as dataloader
-elif args.experiment == 'omniglot':
-    from dataloaders import split_omniglot as dataloader
-elif args.experiment == 'pmnist':
-    from dataloaders import pmnist as dataloader
-
-# Args -- Approach
-if args.approach=='random':
-    from approaches import random as approach
-elif args.approach=='sgd':
-    from approaches import sgd as approach
-elif args.approach=='sgd-restart':
-    from approaches import sgd_restart as approach
-elif args.approach=='sgd-frozen':
-    from approaches import sgd_frozen as approach
-elif args.approach=='lwf':
-    from approaches import lwf as approach
-elif args.approach=='lfl':
-    from approaches import lfl as approach
-elif args.approach=='ewc':
-    from approaches import ewc as approach
-elif args.approach=='ewc-film':
-    from approaches import ewc_film as approach
-elif args.approach=='ewc2':
-    from approaches import ewc2 as approach
-elif args.approach=='imm-mean':
-    from approaches import imm_mean as approach
-elif args.approach=='imm-mode':
-    from approaches import imm_mode as approach
-elif args.approach=='progressive':
-    from approaches import progressive as approach
-elif args.approach=='pathnet':
-    from approaches import pathnet as approach
-elif args.approach=='hat-test':
-    from approaches import hat_test as approach
-elif args.approach=='hat':
-    from approaches import hat as approach
-elif 'gvclf_vd' == args.approach:
-    from approaches import gvclf_vd as approach
-elif 'gvclf' == args.approach:
-    from approaches import gvclf as approach
-elif args.approach=='joint':
-    from approaches import joint as approach
-elif 'vcl' in args.approach:
-    from approaches import gvclf as approach
-
-# Args -- Network
-if args.experiment=='mnist2' or args.experiment=='pmnist':
-    if args.approach=='hat' or args.approach=='hat-test':
-        from networks import mlp_hat as network
-    elif 'gvclf' == args.approach:
-        from networks.gvcl_models import MLPFilm as network
-    elif 'gvclf_vd' in args.approach:
-        from networks.gvcl_models import MLPFilmVD as network
-    else:
-        from networks import mlp as network
-elif args.experiment == 'mixture':
-    if args.approach=='lfl':
-        from networks import alexnet_lfl as network
-    elif args.approach=='hat':
-        from networks import alexnet_hat as network
-    elif args.approach=='progressive':
-        from networks import alexnet_progressive as network
-    elif args.approach=='pathnet':
-        from networks import alexnet_pathnet as network
-    elif args.approach=='ewc-film':
-        from networks import alexnet_ewc_film as network
-    elif args.approach=='hat-test':
-        from networks import alexnet_hat_test as network
-    elif 'vclf' in args.approach:
-        from networks.gvcl_models import AlexNetFiLM as network
-    elif 'vcl' in args.approach:
-        from networks.gvcl_models import AlexNetNoFiLM as network
-    else:
-        from networks import alexnet as network
-    
-
-        
-elif args.experiment == 'cifar' or args.experiment == 'split_cifar100' or args.experiment == 'split_cifar10_100':
-    if args.approach=='lfl':
-        from networks import zenkenet_lfl as network
-    elif args.approach=='hat':
-        from networks import zenkenet_hat as network
-    elif args.approach=='progressive':
-        from networks import zenkenet_progressive as network
-    elif args.approach=='pathnet':
-        from networks import zenkenet_pathnet as network
-    elif args.approach=='hat-test':
-        from networks import zenkenet_hat_test as network
-    elif args.approach=='ewc-film':
-        from networks import zenkenet_ewc_film as network
-    elif 'gvclf' == args.approach:
-        from networks.gvcl_models import CNNFilm as network
-    elif 'gvclf_vd' == args.approach:
-        from networks.gvcl_models import CNNFilmVD as network
-    elif 'gvcl' == args.approach:
-        from networks.gvcl_models import ZenkeNetNoFiLM as network
-    else:   
-        from networks import zenkenet as network
-
-elif 'chasy' in args.experiment:
-    if args.approach=='lfl':
-        from networks import babynet_lfl as network
-    elif args.approach=='hat':
-        from networks import babynet_hat as network
-    elif args.approach=='progressive':
-        from networks import babynet_progressive as network
-    elif args.approach=='pathnet':
-        from networks import babynet_pathnet as network
-    elif args.approach=='ewc-film':
-        from networks import babynet_ewc_film as network
-    elif 'vclf' in args.approach:
-        from networks.gvcl_models import BabyNetFiLM as network
-    elif 'vcl' in args.approach:
-        from networks.gvcl_models import BabyNetNoFiLM as network
-    else:
-        from networks import babynet as network
-
-elif 'smnist' == args.experiment or 'split_mnist' == args.experiment:
-    if args.approach=='lfl':
-        from networks import smnistnet_lfl as network
-    elif args.approach=='hat':
-        from networks import smnistnet_hat as network
-    elif args.approach=='progressive':
-        from networks import smnistnet_progressive as network
-    elif args.approach=='pathnet':
-        from networks import smnistnet_pathnet as network
-    elif args.approach=='hat-test':
-        from networks import smnistnet_hat_test as network
-    elif args.approach=='ewc-film':
-        from networks import smnistnet_ewc_film as network
-    elif args.approach=='ewc2':
-        from networks import smnistnet_binary as network
-    elif 'gvclf' == args.approach:
-        from networks.gvcl_models import MLPFilm as network
-    elif 'gvclf_vd' in args.approach:
-        from networks.gvcl_models import MLPFilmVD as network
-    else:
-        from networks import smnistnet as network
 
-elif args.experiment == 'omniglot':
-    if 'gvclf' == args.approach:
-        from networks.gvcl_models import CNNOmniglotFilm as network
-    elif 'gvclf_vd' in args.approach:
-        from networks.gvcl_models import CNNOmniglotFilmVD as network
-########################################################################################################################
+def run_experiment(config, data=None):
+    """
+        Run the whole task sequence for one configuration (a namespace from arguments.get_args or get_config).
+        config is copied, not modified. data is a dict returned by load_data; pass it to skip loading,
+        the task order is then the one of the seed it was loaded with. Otherwise the tasks are streamed from the loader.
+        Returns the accuracy matrix, the final average accuracy and the backward transfer.
+    """
+    args = deepcopy(config)
+
+    tstart=time.time()
+
+    film=0
+    single_head = 0
+    if args.film:
+        film = 1
+    if args.single_head:
+        single_head = 1
+    best_param, best_lr, best_epochs = get_best_params(args.approach, args.experiment)
+    if len(args.parameter) == 0:
+        params = best_param.split(',')
+    elif len(args.parameter)>=1:
+        params=args.parameter.split(',')
+    beta= float(params[0])
+    lamb= float(params[1])
+
+
+    if args.approach == 'gvclf':
+        log_name = '{}_{}_{}_film_{}_beta_{}_lamb_{}_woDr_{}_lr_{}_batch_{}_epoch_{}_singlehead_{}_prior_var_{}'.format(args.experiment, args.approach,args.seed,
+                                                                        film, beta, lamb, 
+                                                                        args.wo_Dropout, args.lr, args.batch_size, args.nepochs, single_head, args.prior_var)
+
+
+    elif args.approach == 'gvclf_vd':
+        log_name = '{}_{}_{}_film_{}_KLweight_{}_dr_{}_beta_{}_lamb_{}_KLcoeff_{}_samples_{}_conv_Dropout_{}_droptype_{}_lr_{}_batch_{}_epoch_{}_singlehead_{}_prior_var_{}'.format(
+                                                                    args.experiment, args.approach,args.seed, 
+                                                                    film, args.KL_weight, args.droprate, beta, lamb,
+                                                                    args.KL_coeff, 
+                                                                    args.num_samples, args.conv_Dropout, args.drop_type,
+                                                                    args.lr,
+                                                                    args.batch_size, args.nepochs, single_head, args.prior_var)
+
+    if args.experiment in conv_experiment:
+        args.conv = True
+        log_name = log_name + '_conv'
+
+    if args.output=='':
+        args.output = './result_data/' + args.experiment + '/' + args.approach + '/' + log_name + '.txt'
+    print('='*100)
+    print('Arguments =')
+    for arg in vars(args):
+        print('\t'+arg+':',getattr(args,arg))
+    print('='*100)
+
+    ########################################################################################################################
+    if not os.path.isdir('./result_data/'+ args.experiment + '/' + args.approach + '/'):
+        os.makedirs('./result_data/'+ args.experiment + '/' + args.approach + '/')
+
+    device = get_device(args)
+
+    # Seed
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    if torch.cuda.is_available(): 
+        torch.cuda.manual_seed(args.seed)
+
+    # Load, only the current task's training data and the test sets of the tasks seen so far are kept
+    taskcla, inputsize, tasks = stream_data(args, data)
+    if args.ntasks != -1:
+        taskcla = taskcla[:args.ntasks]
+    print('Input size =',inputsize,'\nTask info =',taskcla)
+
+    # Inits
+    print('Inits...')
+    net=get_network(args.experiment,args.approach).Net(inputsize,taskcla,args).to(device)
+    utils.print_model_report(net)
+
+    #Set hyperparameters
+    #best_param, best_lr, best_epochs = get_best_params(args.approach, args.experiment)
+    if args.nepochs == -1:
+        args.nepochs = best_epochs
+        print("using default # epochs of {}".format(best_epochs))
+    if args.lr == -1:
+        args.lr = best_lr
+        print("using default lr of {}".format(best_lr))
+    if len(args.parameter) == 0:
+        args.parameter = best_param
+        print("using default hyperparams of {}".format(best_param))
+
+    appr=get_approach(args.approach).Appr(net,nepochs=args.nepochs,lr=args.lr,args=args, sbatch = args.batch_size)
+
+    print(appr.criterion)
+    utils.print_optimizer_config(appr.optimizer)
+    print('-'*100)
 
-# Load
-print('Load data...')
-data,taskcla,inputsize=dataloader.get(seed=args.seed)
-if args.ntasks != -1:
-    taskcla = taskcla[:args.ntasks]
-print('Input size =',inputsize,'\nTask info =',taskcla)
-
-# Inits
-print('Inits...')
-net=network.Net(inputsize,taskcla).cuda()
-utils.print_model_report(net)
-
-#Set hyperparameters
-#best_param, best_lr, best_epochs = get_best_params(args.approach, args.experiment)
-if args.nepochs == -1:
-    args.nepochs = best_epochs
-    print("using default # epochs of {}".format(best_epochs))
-if args.lr == -1:
-    args.lr = best_lr
-    print("using default lr of {}".format(best_lr))
-if len(args.parameter) == 0:
-    args.parameter = best_param
-    print("using default hyperparams of {}".format(best_param))
-
-appr=approach.Appr(net,nepochs=args.nepochs,lr=args.lr,args=args, sbatch = args.batch_size)
-
-print(appr.criterion)
-utils.print_optimizer_config(appr.optimizer)
-print('-'*100)
-
-# Loop taskki,l
-acc=np.zeros((len(taskcla),len(taskcla)),dtype=np.float32)
-lss=np.zeros((len(taskcla),len(taskcla)),dtype=np.float32)
-for t,ncla in taskcla:
+    # the test sets stay on the device between the evaluations of the task loop
+    test_cache=views.DeviceCache(device,args.test_cache*2**20,{'fp32':None,'fp16':torch.float16,'bf16':torch.bfloat16}[args.test_cache_dtype])
+
+    # Loop taskki,l
+    acc=np.zeros((len(taskcla),len(taskcla)),dtype=np.float32)
+    lss=np.zeros((len(taskcla),len(taskcla)),dtype=np.float32)
+    names=[]
+    test_sets=[]
+    for (t,ncla),(_,task_data) in zip(taskcla,tasks):
+        names.append(task_data['name'])
+        test_sets.append((task_data['test']['x'],task_data['test']['y']))
+        print('*'*100)
+        print('Task {:2d} ({:s})'.format(t,task_data['name']))
+        print('*'*100)
+
+        if args.approach == 'joint':
+            # Get data. We do not put it to GPU
+            if t==0:
+                xtrain=task_data['train']['x']
+                ytrain=task_data['train']['y']
+                xvalid=task_data['valid']['x']
+                yvalid=task_data['valid']['y']
+                task_t=t*torch.ones(xtrain.size(0)).int()
+                task_v=t*torch.ones(xvalid.size(0)).int()
+                task=[task_t,task_v]
+            else:
+                xtrain=torch.cat((xtrain,task_data['train']['x']))
+                ytrain=torch.cat((ytrain,task_data['train']['y']))
+                xvalid=torch.cat((xvalid,task_data['valid']['x']))
+                yvalid=torch.cat((yvalid,task_data['valid']['y']))
+                task_t=torch.cat((task_t,t*torch.ones(task_data['train']['y'].size(0)).int()))
+                task_v=torch.cat((task_v,t*torch.ones(task_data['valid']['y'].size(0)).int()))
+                task=[task_t,task_v]
+        else:
+            # Get data
+            xtrain,ytrain,xvalid,yvalid=views.to_device([task_data['train']['x'],task_data['train']['y'],
+                                                         task_data['valid']['x'],task_data['valid']['y']],device)
+            task=t
+
+        # Train
+        appr.train(task,xtrain,ytrain,xvalid,yvalid)
+        print('-'*100)
+
+        # Test
+        #the test sets of the tasks seen so far are moved in one call, as one working set of the cache
+        moved=test_cache([x for test_set in test_sets for x in test_set])
+        moved=list(zip(moved[0::2],moved[1::2]))
+        if hasattr(appr, 'eval_tasks'):
+            #all the tasks seen so far in one pass over their test sets
+            results=appr.eval_tasks(list(range(t+1)),moved)
+        else:
+            results=[]
+            for u,(xtest,ytest) in enumerate(moved):
+                if args.approach == 'hat':
+                    results.append(appr.eval(u,xtest,ytest,save_preds = True, dset = args.experiment))
+                else:
+                    results.append(appr.eval(u,xtest,ytest,))
+        for u,(test_loss,test_acc) in enumerate(results):
+            print('>>> Test on task {:2d} - {:15s}: loss={:.3f}, acc={:5.1f}% <<<'.format(u,names[u],test_loss,100*test_acc))
+            acc[t,u]=test_acc
+            lss[t,u]=test_loss
+
+        # Save
+        print('Save at '+args.output)
+        np.savetxt(args.output,acc,'%.4f')
+
+    # Print result
+    avg_acc, bwt = print_log_acc_bwt(acc, lss)
+    with open (args.output, 'a') as f:
+        f.write('\n')
+        f.write('avg_acc: ' + str(avg_acc) + '\n')
+        f.write('bwt: ' + str(bwt) + '\n')
+
+    # Done
     print('*'*100)
-    print('Task {:2d} ({:s})'.format(t,data[t]['name']))
+    print('Accuracies =')
+    for i in range(acc.shape[0]):
+        print('\t',end='')
+        for j in range(acc.shape[1]):
+            print('{:5.1f}% '.format(100*acc[i,j]),end='')
+        print()
     print('*'*100)
-
-    if args.approach == 'joint':
-        # Get data. We do not put it to GPU
-        if t==0:
-            xtrain=data[t]['train']['x']
-            ytrain=data[t]['train']['y']
-            xvalid=data[t]['valid']['x']
-            yvalid=data[t]['valid']['y']
-            task_t=t*torch.ones(xtrain.size(0)).int()
-            task_v=t*torch.ones(xvalid.size(0)).int()
-            task=[task_t,task_v]
-        else:
-            xtrain=torch.cat((xtrain,data[t]['train']['x']))
-            ytrain=torch.cat((ytrain,data[t]['train']['y']))
-            xvalid=torch.cat((xvalid,data[t]['valid']['x']))
-            yvalid=torch.cat((yvalid,data[t]['valid']['y']))
-            task_t=torch.cat((task_t,t*torch.ones(data[t]['train']['y'].size(0)).int()))
-            task_v=torch.cat((task_v,t*torch.ones(data[t]['valid']['y'].size(0)).int()))
-            task=[task_t,task_v]
+    print('Done!')
+
+    print('[Elapsed time = {:.1f} h]'.format((time.time()-tstart)/(60*60)))
+
+    if hasattr(appr, 'logs'):
+        if appr.logs is not None:
+            #save task names
+            appr.logs['task_name'] = {}
+            appr.logs['test_acc'] = {}
+            appr.logs['test_loss'] = {}
+            for t,ncla in taskcla:
+                appr.logs['task_name'][t] = deepcopy(names[t])
+                appr.logs['test_acc'][t]  = deepcopy(acc[t,:])
+                appr.logs['test_loss'][t]  = deepcopy(lss[t,:])
+            #pickle
+            import gzip
+            import pickle
+            with gzip.open(os.path.join(appr.logpath), 'wb') as output:
+                pickle.dump(appr.logs, output, pickle.HIGHEST_PROTOCOL)
+
+    ########################################################################################################################
+    result_logger = logger(file_name=args.experiment + "-" + args.approach, resume=True, path='./result_data/csvdata/' + args.experiment + '/', data_format='csv')
+    if 'vd' in args.approach:
+        result_logger.add(
+            seed = args.seed,
+            film = film,
+            KL_weight = args.KL_weight,
+            init_dr = args.droprate,
+            beta = beta,
+            lamb = lamb,
+            avg_acc = avg_acc,
+            file_name = log_name
+            )
     else:
-        # Get data
-        xtrain=data[t]['train']['x'].cuda()
-        ytrain=data[t]['train']['y'].cuda()
-        xvalid=data[t]['valid']['x'].cuda()
-        yvalid=data[t]['valid']['y'].cuda()
-        task=t
-
-    # Train
-    appr.train(task,xtrain,ytrain,xvalid,yvalid)
-    print('-'*100)
-
-    # Test
-    for u in range(t+1):
-        xtest=data[u]['test']['x'].cuda()
-        ytest=data[u]['test']['y'].cuda()
-        if args.approach == 'hat':
-            test_loss,test_acc=appr.eval(u,xtest,ytest,save_preds = True, dset = args.experiment)
-        else:
-            test_loss,test_acc=appr.eval(u,xtest,ytest,)
-        print('>>> Test on task {:2d} - {:15s}: loss={:.3f}, acc={:5.1f}% <<<'.format(u,data[u]['name'],test_loss,100*test_acc))
-        acc[t,u]=test_acc
-        lss[t,u]=test_loss
-
-    # Save
-    print('Save at '+args.output)
-    np.savetxt(args.output,acc,'%.4f')
-
-# Print result
-avg_acc, bwt = print_log_acc_bwt(acc, lss)
-with open (args.output, 'a') as f:
-    f.write('\n')
-    f.write('avg_acc: ' + str(avg_acc) + '\n')
-    f.write('bwt: ' + str(bwt) + '\n')
-
-# Done
-print('*'*100)
-print('Accuracies =')
-for i in range(acc.shape[0]):
-    print('\t',end='')
-    for j in range(acc.shape[1]):
-        print('{:5.1f}% '.format(100*acc[i,j]),end='')
-    print()
-print('*'*100)
-print('Done!')
-
-print('[Elapsed time = {:.1f} h]'.format((time.time()-tstart)/(60*60)))
-
-if hasattr(appr, 'logs'):
-    if appr.logs is not None:
-        #save task names
-        from copy import deepcopy
-        appr.logs['task_name'] = {}
-        appr.logs['test_acc'] = {}
-        appr.logs['test_loss'] = {}
-        for t,ncla in taskcla:
-            appr.logs['task_name'][t] = deepcopy(data[t]['name'])
-            appr.logs['test_acc'][t]  = deepcopy(acc[t,:])
-            appr.logs['test_loss'][t]  = deepcopy(lss[t,:])
-        #pickle
-        import gzip
-        import pickle
-        with gzip.open(os.path.join(appr.logpath), 'wb') as output:
-            pickle.dump(appr.logs, output, pickle.HIGHEST_PROTOCOL)
+        result_logger.add(
+            seed = args.seed,
+            film = film,
+            beta = beta,
+            lamb = lamb,
+            avg_acc = avg_acc,
+            file_name = log_name,
+            )
+    result_logger.save()
+
+    return acc, avg_acc, bwt
 
 ########################################################################################################################
-logger = logger(file_name=args.experiment + "-" + args.approach, resume=True, path='./result_data/csvdata/' + args.experiment + '/', data_format='csv')
-if 'vd' in args.approach:
-    logger.add(
-        seed = args.seed,
-        film = film,
-        KL_weight = args.KL_weight,
-        init_dr = args.droprate,
-        beta = beta,
-        lamb = lamb,
-        avg_acc = avg_acc,
-        file_name = log_name
-        )
-else:
-    logger.add(
-        seed = args.seed,
-        film = film,
-        beta = beta,
-        lamb = lamb,
-        avg_acc = avg_acc,
-        file_name = log_name,
-        )
-logger.save()
-
 
+if __name__ == '__main__':
+    run_experiment(get_args())
@@ -21,33 +21,26 @@ from functools import partial
 
 from abc import ABC, abstractmethod
 from utils import *
-from arguments import get_args
-
-
-device = 'cuda:0'
-
-args = get_args()
-if args.drop_type == 'Gauss':
-    from dropout.Gauss_dropout import GaussDropoutConv2d 
-    from dropout.Gauss_dropout import GaussDropout 
-elif args.drop_type == 'AddNoise':
-    from dropout.AddNoise import Conv2DAddNoise 
-    from dropout.AddNoise import LinearAddNoise 
+from dropout.Gauss_dropout import GaussDropoutConv2d 
+from dropout.Gauss_dropout import GaussDropout 
+from dropout.Gauss_dropout import dropout_kl
+from networks.moments import Moments, split
 
 class MultiHeadFiLMCNN(nn.Module):
-    def __init__(self, input_shape, conv_sizes, fc_sizes, output_dims, film_type = 'point', global_avg_pool = False, prior_var = -1, init_vars = []):
+    def __init__(self, input_shape, conv_sizes, fc_sizes, output_dims, film_type = 'point', global_avg_pool = False, prior_var = -1, init_vars = [], args = None):
         super(MultiHeadFiLMCNN, self).__init__()
+        self.args = args
         self.conv_layers = nn.ModuleList([])
         self.fc_layers = nn.ModuleList([])
         self.heads = nn.ModuleList([])
         self.num_tasks = len(output_dims)
         self.output_dims = output_dims
-        self.single_head = args.single_head
-        self.prior_var = args.prior_var
+        self.single_head = self.args.single_head
+        self.prior_var = self.args.prior_var
         self.global_avg_pool = global_avg_pool
         self.pool_indices = []        
         
-        if args.film:
+        if self.args.film:
             self.film_type = film_type
             self.set_film_gen_type()
             print(self.film_type)
@@ -55,7 +48,7 @@ class MultiHeadFiLMCNN(nn.Module):
             self.fc_film_layers = nn.ModuleList([self.fc_film_gen_type(self.num_tasks, fc_size) for fc_size in fc_sizes])
 
 
-        self.prior_var = args.prior_var
+        self.prior_var = self.args.prior_var
 
         if len(init_vars) == 0:
             init_vars = -7 * np.ones([len(conv_sizes) + len(fc_sizes) + 1])
@@ -76,7 +69,7 @@ class MultiHeadFiLMCNN(nn.Module):
                 padding = int((kernel_size-1)/2)
             else:
                 padding = layer_params[2]
-            conv_layer = MFConvLayer(prev_channels, channels, kernel_size=kernel_size, stride=1, padding=padding, prior_var = self.prior_var, init_var = init_vars[layer_index])
+            conv_layer = MFConvLayer(prev_channels, channels, kernel_size=kernel_size, stride=1, padding=padding, prior_var = self.prior_var, init_var = init_vars[layer_index], fused = self.args.fused_conv)
             
             input_dimension = int(np.floor((input_dimension+2*padding-(kernel_size-1)-1)/float(1)+1))
             prev_channels = channels
@@ -107,9 +100,11 @@ class MultiHeadFiLMCNN(nn.Module):
             for output_dim in output_dims:
                 self.heads.append(MFLinearLayer(last_size, output_dim, prior_var = self.prior_var, init_var = init_vars[layer_index]))
 
+        self.update_kl_prior()
+
     def get_task_specific_parameters(self, task_number):
         modules = nn.ModuleList()
-        if args.film:
+        if self.args.film:
             modules.append(self.conv_film_layers)
             modules.append(self.fc_film_layers)
         if not self.single_head:
@@ -141,6 +136,9 @@ class MultiHeadFiLMCNN(nn.Module):
 
 
     def forward(self, x, task_labels, num_samples=1, tasks = None):
+        """
+            task_labels holds the task of every example, or is an int when the whole batch belongs to one task.
+        """
         if tasks is None:
             tasks = range(self.num_tasks)
             excluded_tasks = []
@@ -153,43 +151,78 @@ class MultiHeadFiLMCNN(nn.Module):
 
         batch_size = x.shape[0]
 
-        x = x.repeat([num_samples,1,1,1])
-
-        x = self.forward_conv(x, task_labels, num_samples, tasks)
-        
-        if self.global_avg_pool:
-            x = x.view(num_samples, batch_size, x.shape[1], -1).mean(-1)
-        else:
-            x = x.view(num_samples, batch_size, -1)
-
-        x = self.forward_linear(x, task_labels, num_samples, tasks)
-            
-        self.pre_head = x
+        x = self.forward_body(x, task_labels, num_samples, tasks)
 
         for j in tasks:
             head_index = 0 if self.single_head else j
             task_output = self.heads[head_index](x)
             outputs[j] = task_output.reshape([num_samples, batch_size, -1])
         for j in excluded_tasks:
-            outputs[j] = torch.zeros_like(task_output, device = device)
+            outputs[j] = torch.zeros_like(task_output)
 
         return outputs
 
 
-    def get_kl(self, lamb = 1):
-        kl = 0
+    def forward_body(self, x, task_labels, num_samples=1, tasks = None):
+        # shared layers, returns the num_samples x batch_size x features input of the heads
+        batch_size = x.shape[0]
 
-        for i, conv_layer in enumerate(self.conv_layers):
-            kl += conv_layer.get_kl(lamb)
+        #x is not replicated across the Monte Carlo samples here: the first stochastic layer computes its
+        #products once per example and broadcasts them over the num_samples noise draws
+        x = self.forward_conv(x, task_labels, num_samples, tasks)
         
-        for layer in self.fc_layers:
-            kl += layer.get_kl(lamb)
-
-        for t, layer in enumerate(self.heads):
-            kl += layer.get_kl(lamb)
+        if self.global_avg_pool:
+            x = x.view(x.shape[0]//batch_size, batch_size, x.shape[1], -1).mean(-1)
+        else:
+            x = x.view(x.shape[0]//batch_size, batch_size, -1)
 
-        return kl
+        x = self.forward_linear(x, task_labels, num_samples, tasks)
+            
+        self.pre_head = x
+        return x
+
+    def forward_routed(self, x, task_labels, segments, num_samples=1):
+        """
+            Forward of a batch mixing several tasks: the shared layers run once on the whole batch and every
+            head only on the rows of its own task. segments are the (task, start, stop) row ranges of the tasks,
+            as given by views.task_batches, so that the routing needs nothing from the device.
+            Returns [(task, rows, output)] for the segments, rows slicing the batch and output being
+            num_samples x (stop - start) x classes.
+        """
+        x = self.forward_body(x, task_labels, num_samples)
+
+        outputs = []
+        for j, start, stop in segments:
+            head_index = 0 if self.single_head else j
+            outputs.append((j, slice(start, stop), self.heads[head_index](x[:, start:stop]).reshape([num_samples, stop - start, -1])))
+        return outputs
 
+    def get_kl(self, lamb = 1):
+        # sum of the get_kl of the conv, fc and head layers, computed over their concatenated parameters
+        prior = {name: getattr(self, 'kl_prior_' + name) for name in ['mean', 'exp_var', 'precision', 'floor', 'excess', 'const']}
+        return compute_kl_flat(self.kl_terms(), prior, lamb = lamb)
+
+    def kl_terms(self):
+        return [term for layer in list(self.conv_layers) + list(self.fc_layers) + list(self.heads) for term in layer.kl_terms()]
+
+    def update_kl_prior(self):
+        # the prior side of get_kl, recomputed whenever the priors change; buffers so that it follows .to(device)
+        for name, value in kl_prior(self.kl_terms()).items():
+            self.register_buffer('kl_prior_' + name, value, persistent = False)
+
+
+    def set_forward_mode(self, mode):
+        # 'sample' (default) draws the noise of every MF and dropout layer
+        # 'moments' propagates means and variances instead of samples, see networks/moments.py
+        for module in self.modules():
+            if module is not self and hasattr(module, 'mode'):
+                module.mode = mode
+
+    def project_parameters(self):
+        # applies the constraints of the modules with a project method, called after every optimizer step
+        for module in self.modules():
+            if module is not self and hasattr(module, 'project'):
+                module.project()
     
     def add_task_body_params(self, updated_tasks):
         for layer in self.fc_layers:
@@ -201,13 +234,14 @@ class MultiHeadFiLMCNN(nn.Module):
         if not self.single_head:
             for t in updated_tasks:
                 self.heads[t].add_new_task(reset_variance = False)
+        self.update_kl_prior()
 
 class MultiHeadFiLMCNNVD(MultiHeadFiLMCNN):
-    def __init__(self, input_shape, conv_sizes, fc_sizes, output_dims, drop_fc_sizes, film_type = 'point', global_avg_pool = False, prior_var = -1, init_vars = []):
-        super().__init__(input_shape, conv_sizes, fc_sizes, output_dims, film_type, global_avg_pool, prior_var, init_vars)
+    def __init__(self, input_shape, conv_sizes, fc_sizes, output_dims, drop_fc_sizes, film_type = 'point', global_avg_pool = False, prior_var = -1, init_vars = [], args = None):
+        super().__init__(input_shape, conv_sizes, fc_sizes, output_dims, film_type, global_avg_pool, prior_var, init_vars, args)
 
         self.set_dropout_gen_type()
-        if args.conv_Dropout:
+        if self.args.conv_Dropout:
             self.conv_dropout_layers = nn.ModuleList()
             s = input_shape[-1]
             prev_channel = input_shape[0]
@@ -221,15 +255,20 @@ class MultiHeadFiLMCNNVD(MultiHeadFiLMCNN):
         self.fc_dropout_layers = nn.ModuleList([self.fc_dropout_gen_type(self.num_tasks, drop_fc_size) for drop_fc_size in drop_fc_sizes])
 
     def set_dropout_gen_type(self):
-        if args.conv_Dropout:
-            self.conv_dropout_gen_type = partial(GaussDropoutConv2d, p = args.droprate)
-        self.fc_dropout_gen_type = partial(GaussDropout, p = args.droprate)
+        if self.args.drop_type == 'AddNoise':
+            from dropout.AddNoise import Conv2DAddNoise as conv_dropout_type
+            from dropout.AddNoise import LinearAddNoise as fc_dropout_type
+        else:
+            conv_dropout_type, fc_dropout_type = GaussDropoutConv2d, GaussDropout
+        if self.args.conv_Dropout:
+            self.conv_dropout_gen_type = partial(conv_dropout_type, p = self.args.droprate)
+        self.fc_dropout_gen_type = partial(fc_dropout_type, p = self.args.droprate)
 
     def get_task_specific_parameters(self, task_number):
         modules = nn.ModuleList([self.fc_dropout_layers])
-        if args.conv_Dropout:
+        if self.args.conv_Dropout:
             modules.append(self.conv_dropout_layers)
-        if args.film:
+        if self.args.film:
             modules.append(self.conv_film_layers)
             modules.append(self.fc_film_layers)
         if not self.single_head:
@@ -242,16 +281,12 @@ class MultiHeadFiLMCNNVD(MultiHeadFiLMCNN):
         return modules.parameters()
 
     def get_dropout_kl(self, task):
-        kl = 0
+        # the log_alpha rows of the task in all the dropout layers, evaluated as one vector
+        layers = list(self.fc_dropout_layers)
+        if self.args.conv_Dropout:
+            layers = list(self.conv_dropout_layers) + layers
 
-        if args.conv_Dropout:
-            for layer in self.conv_dropout_layers:
-                kl += layer.get_kl(task)
-
-        for layer in self.fc_dropout_layers:
-            kl += layer.get_kl(task)
-        
-        return kl 
+        return dropout_kl(torch.cat([layer.log_alpha[task] for layer in layers]))
 
 
 class PointFiLMLayer(nn.Module):
@@ -269,6 +304,11 @@ class PointFiLMLayer(nn.Module):
         init.constant_(self.shifts, 0.)
     
     def forward(self, x, task_labels, num_samples):
+        if isinstance(task_labels, int):
+            #a batch of a single task: its row broadcasts over the batch and the samples
+            shape = [self.width, 1, 1] if self.conv else [self.width]
+            return x * self.scales[task_labels].view(shape) + self.shifts[task_labels].view(shape)
+
         scale_values = F.embedding(task_labels, self.scales)
         shift_values = F.embedding(task_labels, self.shifts)
 
@@ -281,10 +321,24 @@ class PointFiLMLayer(nn.Module):
 
         return x * scale_values + shift_values
 
+def cached_weights(module, params, compute, name='weights'):
+    """
+        Return compute(), reused while none of params is modified (optimizer steps and .data assignments
+        change their _version or storage). Only outside of autograd and compilation: there the cached tensors
+        would carry a graph, so compute() is simply called. name keeps several caches of one module apart.
+    """
+    if torch.is_grad_enabled() or torch.compiler.is_compiling():
+        return compute()
+    key = tuple((p._version, p.data_ptr()) for p in params)
+    cache = module.__dict__.setdefault('_cached_weights', {})
+    if name not in cache or cache[name][0] != key:
+        cache[name] = (key, compute())
+    return cache[name][1]
+
 class MFConvLayer(torch.nn.modules.conv._ConvNd):
     def __init__(self, in_channels, out_channels, kernel_size, stride=1,
                  padding=0, dilation=1, groups=1,
-                 bias=True, padding_mode='zeros', prior_var = 1, init_var = -7, ratio=0.5):
+                 bias=True, padding_mode='zeros', prior_var = 1, init_var = -7, ratio=0.5, fused = False):
         kernel_size = _pair(kernel_size)
         stride = _pair(stride)
         padding = _pair(padding)
@@ -294,10 +348,13 @@ class MFConvLayer(torch.nn.modules.conv._ConvNd):
             False, _pair(0), groups, bias, padding_mode)
         
         self.init_var = init_var
+        #one grouped convolution over [input, input**2] for the mean and the variance instead of two
+        self.fused = fused
+        self.mode = 'sample'
         
-        
-        self.W_prior_mean = torch.zeros(self.weight.shape, device = device)
-        self.b_prior_mean = torch.zeros(self.bias.shape, device = device)
+        #priors are buffers so that they follow the module across .to(device)
+        self.register_buffer('W_prior_mean', torch.zeros(self.weight.shape))
+        self.register_buffer('b_prior_mean', torch.zeros(self.bias.shape))
 
 
         if prior_var == -1:
@@ -320,22 +377,37 @@ class MFConvLayer(torch.nn.modules.conv._ConvNd):
             self.b_var_init = prior_var
 
         
-        self.W_prior_var = torch.ones(self.weight.shape, device = device).mul(np.log(self.w_var_init))
-        self.b_prior_var = torch.ones(self.bias.shape, device = device).mul(np.log(self.b_var_init))
+        self.register_buffer('W_prior_var', torch.ones(self.weight.shape).mul(np.log(self.w_var_init)))
+        self.register_buffer('b_prior_var', torch.ones(self.bias.shape).mul(np.log(self.b_var_init)))
         self.weight_var = Parameter(torch.Tensor(self.weight.shape))
         self.bias_var = Parameter(torch.Tensor(self.bias.shape))
         
         self.reset_parameters()
 
-    def conv2d_forward(self, input, weight, bias):
+    def conv2d_forward(self, input, weight, bias, groups=None):
+        if groups is None:
+            groups = self.groups
         if self.padding_mode == 'circular':
             expanded_padding = ((self.padding[1] + 1) // 2, self.padding[1] // 2,
                                 (self.padding[0] + 1) // 2, self.padding[0] // 2)
             return F.conv2d(F.pad(input, expanded_padding, mode='circular'),
                             weight, bias, self.stride,
-                            _pair(0), self.dilation, self.groups)
+                            _pair(0), self.dilation, groups)
         return F.conv2d(input, weight, bias, self.stride,
-                        self.padding, self.dilation, self.groups)
+                        self.padding, self.dilation, groups)
+
+    def variance_weights(self):
+        # exp(weight_var) and exp(bias_var), for the fused convolution stacked under the mean weight and bias
+        if self.fused:
+            return cached_weights(self, [self.weight, self.bias, self.weight_var, self.bias_var],
+                                  lambda: (torch.cat([self.weight, torch.exp(self.weight_var)], 0), torch.cat([self.bias, torch.exp(self.bias_var)], 0)))
+        return cached_weights(self, [self.weight_var, self.bias_var], lambda: (torch.exp(self.weight_var), torch.exp(self.bias_var)))
+
+    def moment_weights(self):
+        # exp(weight_var), exp(weight_var) + weight**2 and exp(bias_var) for the moment propagation
+        return cached_weights(self, [self.weight, self.weight_var, self.bias_var],
+                              lambda: (torch.exp(self.weight_var), torch.exp(self.weight_var) + self.weight**2, torch.exp(self.bias_var)),
+                              name='moments')
 
     def reset_parameters(self):
         super().reset_parameters()
@@ -370,15 +442,51 @@ class MFConvLayer(torch.nn.modules.conv._ConvNd):
 
         return W_kl + b_kl
 
-    def forward(self, input):
-        output_mean =  self.conv2d_forward(input, self.weight, self.bias)
-        output_var = self.conv2d_forward(input**2, torch.exp(self.weight_var), torch.exp(self.bias_var))
+    def kl_terms(self):
+        # (mean, log variance, prior mean, prior log variance, initial prior variance) of the weight and the bias
+        return [(self.weight, self.weight_var, self.W_prior_mean, self.W_prior_var, self.w_var_init),
+                (self.bias, self.bias_var, self.b_prior_mean, self.b_prior_var, self.b_var_init)]
+
+    def forward(self, input, num_samples=1):
+        """
+            With num_samples > 1, input holds one copy of each example and the output holds num_samples noisy
+            copies stacked along the batch dimension, like the output for input.repeat([num_samples,1,1,1]).
+        """
+        if self.mode == 'moments':
+            return self.forward_moments(input)
+
+        #under bf16 autocast the convolutions run in reduced precision, the sampling is done in fp32
+        weight_var, bias_var = self.variance_weights()
+        if self.fused:
+            output = self.conv2d_forward(torch.cat([input, input**2], 1), weight_var, bias_var, 2*self.groups).float()
+            output_mean, output_var = output.chunk(2, 1)
+        else:
+            output_mean =  self.conv2d_forward(input, self.weight, self.bias).float()
+            output_var = self.conv2d_forward(input**2, weight_var, bias_var).float()
+
+        if num_samples > 1:
+            eps = torch.empty((num_samples,) + output_mean.shape, device=output_mean.device).normal_(mean=0,std=1)
+            output = output_mean + torch.sqrt(output_var + 1e-9) * eps
+            return output.view((-1,) + output_mean.shape[1:])
 
-        eps = torch.empty(output_mean.shape, device=device).normal_(mean=0,std=1)
+        eps = torch.empty(output_mean.shape, device=output_mean.device).normal_(mean=0,std=1)
         output = output_mean + torch.sqrt(output_var + 1e-9) * eps
 
         return output 
 
+    def forward_moments(self, input):
+        """
+            Mean and variance of the output for a Moments input, or a plain tensor of zero variance,
+            with the weights integrated out instead of sampled.
+        """
+        mean, var = split(input)
+        weight_var, weight_second, bias_var = self.moment_weights()
+        output_mean = self.conv2d_forward(mean, self.weight, self.bias).float()
+        output_var = self.conv2d_forward(mean**2, weight_var, bias_var).float()
+        if var is not None:
+            output_var = output_var + self.conv2d_forward(var, weight_second, None).float()
+        return Moments(output_mean, output_var)
+
 
 class MFLinearLayer(nn.Module):
     def __init__(self, dim_in, dim_out, prior_var = -1, init_var = -7, ratio=0.5):
@@ -391,9 +499,11 @@ class MFLinearLayer(nn.Module):
 
         self.W_var = Parameter(torch.Tensor(dim_out, dim_in))
         self.b_var = Parameter(torch.Tensor(dim_out))
+        #'sample' draws the local reparameterization noise, 'moments' propagates the mean and variance of the activations
+        self.mode = 'sample'
 
-        self.W_prior_mean = torch.zeros([dim_out, dim_in], device = device)
-        self.b_prior_mean = torch.zeros([dim_out], device = device)
+        self.register_buffer('W_prior_mean', torch.zeros([dim_out, dim_in]))
+        self.register_buffer('b_prior_mean', torch.zeros([dim_out]))
 
 
         if prior_var == -1:
@@ -415,8 +525,8 @@ class MFLinearLayer(nn.Module):
             self.w_var_init = prior_var
             self.b_var_init = prior_var
         
-        self.W_prior_var = torch.ones([dim_out, dim_in], device = device).mul(np.log(self.w_var_init))
-        self.b_prior_var = torch.ones([dim_out], device = device).mul(np.log(self.b_var_init))
+        self.register_buffer('W_prior_var', torch.ones([dim_out, dim_in]).mul(np.log(self.w_var_init)))
+        self.register_buffer('b_prior_var', torch.ones([dim_out]).mul(np.log(self.b_var_init)))
 
         self.reset_parameters()
 
@@ -457,14 +567,58 @@ class MFLinearLayer(nn.Module):
         b_kl = compute_kl(self.b_mean, self.b_var, self.b_prior_mean, self.b_prior_var, lamb = lamb, initial_prior_var = self.b_var_init)
         return W_kl + b_kl
 
-    def forward(self, x):
-        output_mean = x.matmul(self.W_mean.t()) + self.b_mean.unsqueeze(0).unsqueeze(0)
-        output_std = torch.sqrt((x**2).matmul(torch.exp(self.W_var.t())) + torch.exp(self.b_var).unsqueeze(0).unsqueeze(0))
-        eps = torch.empty(output_mean.shape, device=device).normal_(mean=0,std=1)
+    def kl_terms(self):
+        # (mean, log variance, prior mean, prior log variance, initial prior variance) of the weight and the bias
+        return [(self.W_mean, self.W_var, self.W_prior_mean, self.W_prior_var, self.w_var_init),
+                (self.b_mean, self.b_var, self.b_prior_mean, self.b_prior_var, self.b_var_init)]
+
+    def stacked_weights(self):
+        # [W_mean; exp(W_var)] as dim_in x dim_out matrices and [b_mean; exp(b_var)] for the batched product
+        return cached_weights(self, [self.W_mean, self.b_mean, self.W_var, self.b_var],
+                              lambda: (torch.stack([self.W_mean.t(), torch.exp(self.W_var).t()]),
+                                       torch.stack([self.b_mean, torch.exp(self.b_var)]).unsqueeze(1)))
+
+    def moment_weights(self):
+        # exp(W_var) and exp(W_var) + W_mean**2 as dim_in x dim_out matrices and exp(b_var) for the moment propagation
+        return cached_weights(self, [self.W_mean, self.W_var, self.b_var],
+                              lambda: (torch.exp(self.W_var).t(), (torch.exp(self.W_var) + self.W_mean**2).t(), torch.exp(self.b_var)),
+                              name='moments')
+
+    def forward(self, x, num_samples=1):
+        """
+            x is samples x batch x dim_in. With num_samples > 1 it holds a single sample and the output
+            holds num_samples noisy samples drawn around the same mean and variance.
+        """
+        if self.mode == 'moments':
+            return self.forward_moments(x)
+
+        #one batched product gives the mean and the variance, the fp32 biases promote it back to fp32 under bf16 autocast
+        weight, bias = self.stacked_weights()
+        flat = x.reshape(-1, self.dim_in)
+        output = torch.bmm(torch.stack([flat, flat**2]), weight) + bias
+        shape = torch.broadcast_shapes(x.shape[:-1] + (self.dim_out,), (1, 1, self.dim_out))
+        output_mean = output[0].view(shape)
+        output_std = torch.sqrt(output[1]).view(shape)
+        if num_samples > 1:
+            shape = (num_samples,) + shape[1:]
+        eps = torch.empty(shape, device=output_mean.device).normal_(mean=0,std=1)
 
         output = output_mean + (eps * output_std)
         return output
 
+    def forward_moments(self, x):
+        """
+            Mean and variance of the output for a Moments input, or a plain tensor of zero variance,
+            with the weights integrated out instead of sampled.
+        """
+        mean, var = split(x)
+        weight_var, weight_second, bias_var = self.moment_weights()
+        output_mean = mean.matmul(self.W_mean.t()) + self.b_mean
+        output_var = (mean**2).matmul(weight_var) + bias_var
+        if var is not None:
+            output_var = output_var + var.matmul(weight_second)
+        return Moments(output_mean.float(), output_var.float())
+
 
 
 def _calculate_fan_in_and_fan_out(tensor):
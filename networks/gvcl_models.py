@@ -20,27 +20,23 @@ import numpy as np
 from torch.nn import init
 from functools import partial
 
-from arguments import get_args
-
-args = get_args()
-
 class MLPFilmVD:
     class Net(MultiHeadFiLMCNNVD):
-        def __init__(self, inputsize,taskcla):
+        def __init__(self, inputsize,taskcla,args):
             heads = [t[1] for t in taskcla]
             if not args.single_head:
-                super().__init__((1,28,28), [], [256,256], heads, [28*28, 256], film_type = 'point')
+                super().__init__((1,28,28), [], [256,256], heads, [28*28, 256], film_type = 'point', args = args)
             else:
-                super().__init__((1,28,28), [], [400,400], heads, [28*28, 400, 400], film_type = 'point')
+                super().__init__((1,28,28), [], [400,400], heads, [28*28, 400, 400], film_type = 'point', args = args)
         
         def forward_linear(self, x, task_labels, num_samples=1, tasks = None):
             for i, layer in enumerate(self.fc_layers):
                 x = self.fc_dropout_layers[i](x, task_labels, num_samples)
                 x = layer(x)
-                if args.film:
+                if self.args.film:
                     x = self.fc_film_layers[i](x, task_labels, num_samples)
                 x = F.relu(x)
-            if args.single_head:
+            if self.args.single_head:
                 x = self.fc_dropout_layers[-1](x, task_labels, num_samples)
             return x
 
@@ -50,24 +46,25 @@ class MLPFilmVD:
 
 class CNNFilmVD:
     class Net(MultiHeadFiLMCNNVD):
-        def __init__(self, inputsize,taskcla):
+        def __init__(self, inputsize,taskcla,args):
             heads = [t[1] for t in taskcla]
             super().__init__((3,32,32), [(32, 3, 1), (32, 3, 1), 'pool', (64, 3, 1), (64, 3, 1), 'pool', (128, 3, 1), (128, 3, 1), 'pool'], [256], heads, 
-                            [256], film_type = 'point')
+                            [256], film_type = 'point', args = args)
             if not args.conv_Dropout:     
                 self.drop = nn.Dropout(0.25)
 
         def forward_conv(self, x, task_labels, num_samples=1, tasks = None):
             drop_index = 0
             for i, conv_layer in enumerate(self.conv_layers):
-                x = conv_layer(x)
-                if args.film:
+                #the first layer draws the Monte Carlo samples
+                x = conv_layer(x, num_samples if i == 0 else 1)
+                if self.args.film:
                     x = self.conv_film_layers[i](x, task_labels, num_samples)
                 
                 x = F.relu(x)
                 if i in self.pool_indices:
                     x = F.max_pool2d(x, kernel_size = 2, stride = 2)
-                    if args.conv_Dropout:
+                    if self.args.conv_Dropout:
                         x = self.conv_dropout_layers[drop_index](x, task_labels, num_samples)
                     else:
                         x = self.drop(x)
@@ -77,7 +74,7 @@ class CNNFilmVD:
         def forward_linear(self, x, task_labels, num_samples=1, tasks = None):
             for i, layer in enumerate(self.fc_layers):
                 x = layer(x)
-                if args.film:
+                if self.args.film:
                     x = self.fc_film_layers[i](x, task_labels, num_samples)
                 x = F.relu(x)
                 x = self.fc_dropout_layers[i](x, task_labels, num_samples)
@@ -85,24 +82,25 @@ class CNNFilmVD:
 
 class CNNOmniglotFilmVD:
     class Net(MultiHeadFiLMCNNVD):
-        def __init__(self, inputsize,taskcla):
+        def __init__(self, inputsize,taskcla,args):
             heads = [t[1] for t in taskcla]
             super().__init__((1,28,28), [(64, 3, 0), (64, 3, 0), 'pool', (64, 3, 0), (64, 3, 0), 'pool'], [], heads, 
-                                        [1024], film_type = 'point')
+                                        [1024], film_type = 'point', args = args)
             if not args.conv_Dropout:     
                 self.drop = nn.Dropout(args.droprate_linear)
 
         def forward_conv(self, x, task_labels, num_samples=1, tasks = None):
             drop_index = 0
             for i, conv_layer in enumerate(self.conv_layers):
-                x = conv_layer(x)
-                if args.film:
+                #the first layer draws the Monte Carlo samples
+                x = conv_layer(x, num_samples if i == 0 else 1)
+                if self.args.film:
                     x = self.conv_film_layers[i](x, task_labels, num_samples)
                 
                 x = F.relu(x)
                 if i in self.pool_indices:
                     x = F.max_pool2d(x, kernel_size = 2, stride = 2)
-                    if args.conv_Dropout:
+                    if self.args.conv_Dropout:
                         x = self.conv_dropout_layers[drop_index](x, task_labels, num_samples)
                     else:
                         x = self.drop(x)
@@ -110,28 +108,29 @@ class CNNOmniglotFilmVD:
             return x
 
         def forward_linear(self, x, task_labels, num_samples=1, tasks = None):
-            if not args.conv_Dropout:
+            if not self.args.conv_Dropout:
                 x = self.fc_dropout_layers[0](x, task_labels, num_samples)
             return x
 
 class MLPFilm:
     class Net(MultiHeadFiLMCNN):
-        def __init__(self, inputsize,taskcla):
+        def __init__(self, inputsize,taskcla,args):
             heads = [t[1] for t in taskcla]
             if not args.single_head:
-                super().__init__((1,28,28), [], [256,256], heads, film_type = 'point')
+                super().__init__((1,28,28), [], [256,256], heads, film_type = 'point', args = args)
             else:
-                super().__init__((1,28,28), [], [400,400], heads, film_type = 'point')
+                super().__init__((1,28,28), [], [400,400], heads, film_type = 'point', args = args)
             if not args.wo_Dropout:
                 self.drop = torch.nn.Dropout(args.droprate_linear)
         
         def forward_linear(self, x, task_labels, num_samples=1, tasks = None):
             for i, layer in enumerate(self.fc_layers):
-                x = layer(x)
-                if args.film:
+                #the first layer draws the Monte Carlo samples
+                x = layer(x, num_samples if i == 0 else 1)
+                if self.args.film:
                     x = self.fc_film_layers[i](x, task_labels, num_samples)
                 x = F.relu(x)
-                if not args.wo_Dropout:
+                if not self.args.wo_Dropout:
                     x = self.drop(x)
             return x
 
@@ -140,23 +139,24 @@ class MLPFilm:
 
 class CNNOmniglotFilm:
     class Net(MultiHeadFiLMCNN):
-        def __init__(self, inputsize,taskcla):
+        def __init__(self, inputsize,taskcla,args):
             heads = [t[1] for t in taskcla]
             super().__init__((1,28,28), [(64, 3, 0), (64, 3, 0), 'pool', (64, 3, 0), (64, 3, 0), 'pool'], [], heads, 
-                                        film_type = 'point')
+                                        film_type = 'point', args = args)
             if not args.wo_Dropout:
                 self.drop = nn.Dropout(args.droprate_linear)
 
         def forward_conv(self, x, task_labels, num_samples=1, tasks = None):
             for i, conv_layer in enumerate(self.conv_layers):
-                x = conv_layer(x)
-                if args.film:
+                #the first layer draws the Monte Carlo samples
+                x = conv_layer(x, num_samples if i == 0 else 1)
+                if self.args.film:
                     x = self.conv_film_layers[i](x, task_labels, num_samples)
                 
                 x = F.relu(x)
                 if i in self.pool_indices:
                     x = F.max_pool2d(x, kernel_size = 2, stride = 2)
-                    if not args.wo_Dropout:
+                    if not self.args.wo_Dropout:
                         x = self.drop(x)
             return x
 
@@ -165,34 +165,35 @@ class CNNOmniglotFilm:
 
 class CNNFilm:
     class Net(MultiHeadFiLMCNN):
-        def __init__(self, inputsize,taskcla):
+        def __init__(self, inputsize,taskcla,args):
             heads = [t[1] for t in taskcla]
             super().__init__((3,32,32), [(32, 3, 1), (32, 3, 1), 'pool', (64, 3, 1), (64, 3, 1), 'pool', (128, 3, 1), (128, 3, 1), 'pool'], [256], heads, 
-                                        film_type = 'point')
+                                        film_type = 'point', args = args)
             if not args.wo_Dropout:
                 self.drop1 = nn.Dropout(args.droprate)
                 self.drop2 = nn.Dropout(args.droprate_linear)
 
         def forward_conv(self, x, task_labels, num_samples=1, tasks = None):
             for i, conv_layer in enumerate(self.conv_layers):
-                x = conv_layer(x)
-                if args.film:
+                #the first layer draws the Monte Carlo samples
+                x = conv_layer(x, num_samples if i == 0 else 1)
+                if self.args.film:
                     x = self.conv_film_layers[i](x, task_labels, num_samples)
                 
                 x = F.relu(x)
                 if i in self.pool_indices:
                     x = F.max_pool2d(x, kernel_size = 2, stride = 2)
-                    if not args.wo_Dropout:
+                    if not self.args.wo_Dropout:
                         x = self.drop1(x)
             return x
 
         def forward_linear(self, x, task_labels, num_samples=1, tasks = None):
             for i, layer in enumerate(self.fc_layers):
                 x = layer(x)
-                if args.film:
+                if self.args.film:
                     x = self.fc_film_layers[i](x, task_labels, num_samples)
                 x = F.relu(x)
-                if not args.wo_Dropout:
+                if not self.args.wo_Dropout:
                     x = self.drop2(x)
             return x
 
@@ -0,0 +1,135 @@
+import math
+import torch
+from torch.nn import functional as F
+
+########################################################################################################################
+# Deterministic moment propagation.
+#
+# Instead of averaging the predictions of several noisy forward passes, the mean and the variance of every activation
+# are pushed through the network analytically, treating activations as independent Gaussians. The MF and Gaussian
+# dropout layers map Moments to Moments in their 'moments' forward mode; everything the networks' forward code
+# applies in between (relu, max_pool2d, dropout, the FiLM affine maps, reshapes) is dispatched to the handlers below
+# through __torch_function__, so the models run unchanged. The softmax of the logits is the probit approximation
+# softmax(mean / sqrt(1 + pi/8 var)), which gives the predictive distribution in a single pass.
+
+HANDLED = {}
+
+def implements(*funcs):
+    def register(handler):
+        for func in funcs:
+            HANDLED[func] = handler
+        return handler
+    return register
+
+
+class Moments(object):
+    def __init__(self, mean, var):
+        """
+            :param mean: tensor of activation means
+            :param var: tensor of activation variances with the same shape
+        """
+        self.mean = mean
+        self.var = var
+
+    @classmethod
+    def __torch_function__(cls, func, types, args=(), kwargs=None):
+        if func not in HANDLED:
+            return NotImplemented
+        return HANDLED[func](*args, **(kwargs or {}))
+
+    @property
+    def shape(self):
+        return self.mean.shape
+
+    @property
+    def device(self):
+        return self.mean.device
+
+    def size(self, dim=None):
+        return self.mean.size() if dim is None else self.mean.size(dim)
+
+    def dim(self):
+        return self.mean.dim()
+
+    def view(self, *shape):
+        return Moments(self.mean.view(*shape), self.var.view(*shape))
+
+    def reshape(self, *shape):
+        return Moments(self.mean.reshape(*shape), self.var.reshape(*shape))
+
+    def __getitem__(self, index):
+        return Moments(self.mean[index], self.var[index])
+
+    def float(self):
+        return Moments(self.mean.float(), self.var.float())
+
+    def __mul__(self, other):
+        # scaling by a deterministic tensor
+        return Moments(self.mean * other, self.var * other**2)
+
+    __rmul__ = __mul__
+
+    def __add__(self, other):
+        # shift by a deterministic tensor
+        return Moments(self.mean + other, self.var)
+
+    __radd__ = __add__
+
+
+def split(x):
+    # mean and variance of a Moments or of a deterministic tensor
+    if isinstance(x, Moments):
+        return x.mean, x.var
+    return x, None
+
+def _normal_pdf(z):
+    return torch.exp(-0.5 * z**2) / math.sqrt(2 * math.pi)
+
+def _normal_cdf(z):
+    return 0.5 * (1 + torch.erf(z / math.sqrt(2)))
+
+@implements(F.relu, torch.relu)
+def relu(x, inplace=False):
+    # moments of the rectified Gaussian
+    s = torch.sqrt(x.var + 1e-12)
+    z = x.mean / s
+    cdf, pdf = _normal_cdf(z), _normal_pdf(z)
+    mean = x.mean * cdf + s * pdf
+    second = (x.mean**2 + x.var) * cdf + x.mean * s * pdf
+    return Moments(mean, torch.clamp(second - mean**2, min=0))
+
+def _max(a, b):
+    # Clark's moments of the maximum of two independent Gaussians
+    theta = torch.sqrt(a.var + b.var + 1e-12)
+    z = (a.mean - b.mean) / theta
+    cdf, cdf_neg, pdf = _normal_cdf(z), _normal_cdf(-z), _normal_pdf(z)
+    mean = a.mean * cdf + b.mean * cdf_neg + theta * pdf
+    second = (a.mean**2 + a.var) * cdf + (b.mean**2 + b.var) * cdf_neg + (a.mean + b.mean) * theta * pdf
+    return Moments(mean, torch.clamp(second - mean**2, min=0))
+
+@implements(F.max_pool2d)
+def max_pool2d(x, kernel_size, stride=None, padding=0, dilation=1, ceil_mode=False, return_indices=False):
+    # pairwise maxima over the non-overlapping 2x2 windows the networks use
+    if stride is None:
+        stride = kernel_size
+    if kernel_size not in (2, (2, 2)) or stride not in (2, (2, 2)) or padding != 0 or dilation != 1 or ceil_mode or return_indices:
+        raise NotImplementedError('moment propagation only supports 2x2 max pooling with stride 2')
+    h, w = x.shape[-2] // 2 * 2, x.shape[-1] // 2 * 2
+    corner = lambda i, j: Moments(x.mean[..., i:h:2, j:w:2], x.var[..., i:h:2, j:w:2])
+    return _max(_max(corner(0, 0), corner(0, 1)), _max(corner(1, 0), corner(1, 1)))
+
+@implements(F.dropout)
+def dropout(x, p=0.5, training=True, inplace=False):
+    # standard dropout is the identity at evaluation
+    if training:
+        raise NotImplementedError('moment propagation is an evaluation mode')
+    return x
+
+@implements(F.softmax)
+def softmax(x, dim=None, _stacklevel=3, dtype=None):
+    # probit approximation of the expected softmax
+    return F.softmax(x.mean / torch.sqrt(1 + math.pi / 8 * x.var), dim=dim, dtype=dtype)
+
+@implements(torch.zeros_like)
+def zeros_like(x, **kwargs):
+    return Moments(torch.zeros_like(x.mean, **kwargs), torch.zeros_like(x.var, **kwargs))
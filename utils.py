@@ -60,22 +60,75 @@ def compute_conv_output_size(Lin,kernel_size,stride=1,padding=0,dilation=1):
 
 ########################################################################################################################
 
-def compute_mean_std_dataset(dataset):
+def compute_mean_std_dataset(dataset, batch_size=256):
     # dataset already put ToTensor
+    # single pass, per-channel moments of each batch are merged as in Chan et al.
+    count=0
     mean=0
-    std=0
-    loader = torch.utils.data.DataLoader(dataset, batch_size=1, shuffle=False)
-    for image, _ in loader:
-        mean+=image.mean(3).mean(2)
-    mean /= len(dataset)
-
-    mean_expanded=mean.view(mean.size(0),mean.size(1),1,1).expand_as(image)
+    m2=0
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False)
     for image, _ in loader:
-        std+=(image-mean_expanded).pow(2).sum(3).sum(2)
-
-    std=(std/(len(dataset)*image.size(2)*image.size(3)-1)).sqrt()
-
-    return mean, std
+        pixels=image.double().transpose(0,1).reshape(image.size(1),-1)
+        n=pixels.size(1)
+        batch_mean=pixels.mean(1)
+        batch_m2=(pixels-batch_mean.view(-1,1)).pow(2).sum(1)
+        delta=batch_mean-mean
+        mean=mean+delta*n/(count+n)
+        m2=m2+batch_m2+delta.pow(2)*count*n/(count+n)
+        count+=n
+
+    std=(m2/(count-1)).sqrt()
+
+    return mean.float().view(1,-1), std.float().view(1,-1)
+
+def images_to_uint8(images):
+    # raw uint8 .data of a torchvision dataset, either N x H x W or N x H x W x C, as a contiguous N x C x H x W tensor
+    # the loaders keep images in this form and normalise each gathered batch (see dataloaders.views.TensorView)
+    x=torch.as_tensor(np.asarray(images))
+    if x.dim()==3:
+        x=x.unsqueeze(1)
+    else:
+        x=x.permute(0,3,1,2)
+    return x.contiguous()
+
+def autocast(args, device):
+    # --precision bf16 runs the products of the forward pass in bfloat16 on cpu and cuda, fp32 is a no-op context
+    # the MF layers return fp32 and the KL terms are computed outside of it, so they stay in full precision
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=args.precision=='bf16')
+
+def activation_bytes(model, *inputs, **kwargs):
+    # bytes written by the leaf modules of the network for model(*inputs, **kwargs), a probe forward of one example
+    # and one sample gives the activation cost of each row of an evaluation batch
+    # intermediate results are not freed in between, so the sum bounds the peak from above
+    total=[0]
+    def count(module, args, output):
+        for o in output if isinstance(output,(list,tuple)) else [output]:
+            #Moments outputs of the moment propagation hold a mean and a variance
+            for x in [o] if torch.is_tensor(o) else [getattr(o,'mean',None),getattr(o,'var',None)]:
+                if torch.is_tensor(x):
+                    total[0]+=x.numel()*x.element_size()
+    hooks=[m.register_forward_hook(count) for m in model.modules() if next(m.children(),None) is None]
+    try:
+        with torch.no_grad():
+            model(*inputs, **kwargs)
+    finally:
+        for h in hooks:
+            h.remove()
+    return total[0]
+
+def plan_eval(row_bytes, num_samples, budget, min_batch, n):
+    """
+        Evaluation batch size and Monte Carlo samples per forward pass for activations of row_bytes per example
+        and sample within budget bytes. The batch holds all num_samples samples when at least min_batch examples
+        (or all n) fit, otherwise the samples are split into the fewest chunks that allow it.
+    """
+    rows=max(1,int(budget//row_bytes))
+    min_batch=min(min_batch,n)
+    chunks,samples=1,num_samples
+    while samples>1 and rows//samples<min_batch:
+        chunks+=1
+        samples=-(-num_samples//chunks)
+    return max(1,min(n,rows//samples)),samples
 
 ########################################################################################################################
 
@@ -90,7 +143,7 @@ def fisher_matrix_diag(t,x,y,model,criterion,sbatch=5, pass_t = False):
     model.train()
     samples_taken = 0
     for i in tqdm(range(0,x.size(0),sbatch),desc='Fisher diagonal',ncols=100,ascii=True):
-        b=torch.LongTensor(np.arange(i,np.min([i+1,x.size(0)]))).cuda()
+        b=torch.LongTensor(np.arange(i,np.min([i+1,x.size(0)]))).to(x.device)
         images=torch.autograd.Variable(x[b],volatile=False)
         target=torch.autograd.Variable(y[b],volatile=False)
         # Forward and backward
@@ -177,6 +230,33 @@ def compute_kl(mean, exp_var, prior_mean, prior_exp_var, sum = True, lamb = 1, i
     else:
         return 0.5 * (trace_term + mean_term + det_term - 1)
 
+def kl_prior(terms):
+    """
+        Prior side of compute_kl for a list of (mean, exp_var, prior_mean, prior_exp_var, initial_prior_var) terms,
+        concatenated into flat vectors. It only changes with the priors, i.e. once per task.
+    """
+    with torch.no_grad():
+        prior_mean = torch.cat([pm.reshape(-1) for m, v, pm, pv, ipv in terms])
+        prior_exp_var = torch.cat([pv.reshape(-1) for m, v, pm, pv, ipv in terms])
+        precision = torch.exp(-prior_exp_var)
+        #tempered precision lamb * excess + floor, see compute_kl
+        floor = torch.cat([torch.full([pv.numel()], 1/ipv, device=pv.device) for m, v, pm, pv, ipv in terms])
+        excess = torch.clamp(precision - floor, min = 0.0)
+        const = prior_exp_var.sum() - prior_exp_var.numel()
+    return {'mean': prior_mean, 'exp_var': prior_exp_var, 'precision': precision, 'floor': floor, 'excess': excess, 'const': const}
+
+def compute_kl_flat(terms, prior, lamb = 1):
+    # sum of compute_kl over the terms as one reduction over the concatenated parameters, prior from kl_prior
+    mean = torch.cat([m.reshape(-1) for m, v, pm, pv, ipv in terms])
+    exp_var = torch.cat([v.reshape(-1) for m, v, pm, pv, ipv in terms])
+    if lamb != 1:
+        precision = torch.add(prior['floor'], prior['excess'], alpha = lamb)
+    else:
+        precision = prior['precision']
+    trace_term = torch.exp(exp_var - prior['exp_var'])
+    mean_term = (mean - prior['mean'])**2 * precision
+    return 0.5 * (torch.sum(trace_term + mean_term - exp_var) + prior['const'])
+
 ########################################################################################################################
 
 def print_log_acc_bwt(acc, lss):
@@ -230,7 +310,7 @@ class logger(object):
                            test_loss=test_loss)
         """
         df = pd.DataFrame([kwargs.values()], columns=kwargs.keys())
-        self.log = self.log.append(df, ignore_index=True)
+        self.log = pd.concat([self.log, df], ignore_index=True)
 
 
     def save(self):